@@ -5,13 +5,21 @@ import { shallowRef, watch } from "vue";
 export class MUCOAPI {
     constructor() {}
 
-    connmeta(nick, protover, uuid) {
-        return {
+    connmeta(nick, protover, uuid, token, from) {
+        let packet = {
             type: "connmeta",
             nickname: nick,
             version: protover,
-            uuid: uuid
+            uuid: uuid,
+            batch: true,
+            resume: true
+        }
+        // resume the previous session, server sends only messages after "from"
+        if (token != undefined) {
+            packet.token = token;
+            packet.from = from;
         }
+        return packet
     }
 
     connaccept(uuid) {
@@ -71,16 +79,27 @@ export class MUCOAPI {
         }
     }
 
-    getHistory(uuid, from) {
+    // with limit it is a catch-up: only the newest "limit" messages after "from",
+    // the server resets "from" if it belongs to another history epoch
+    getHistory(uuid, from, limit, epoch) {
         if (from == undefined) {
             return {
                 type: "getHistory",
                 uuid: uuid
             }
+        } else if (limit == undefined) {
+            return {
+                type: "getHistory",
+                from: from,
+                uuid: uuid
+            }
         } else {
             return {
                 type: "getHistory",
                 from: from,
+                limit: limit,
+                latest: true,
+                epoch: epoch,
                 uuid: uuid
             }
         }
@@ -116,6 +135,17 @@ export class MUCOData {
         this.connectedTo = null;
         this.isConnected = false;
         this.checker = null;
+
+        // seq of the last server message we have, used to load only missed messages on reconnect
+        this.lastSeq = 0;
+        this.lastSeqServer = null;
+        // history epoch from connaccept, seq starts over when it changes (e.g. server restarted without message log)
+        this.epoch = null;
+        this.lastSeqEpoch = null;
+
+        // session resume token from connaccept, valid for the server it came from
+        this.resumeToken = null;
+        this.resumeServer = null;
     }
 }
 
@@ -240,20 +270,47 @@ export class MUCOReceiver {
     connmetaHandler(packet) {
         console.log(`[receiver]: Got server-side connmeta, serverUUID is ${packet.uuid}`);
         this.data.serverUUID = packet.uuid;
+        let resume = this.data.resumeToken != null && this.data.resumeServer == this.data.connectedTo;
         this.ws.send(
             this.data.api.connmeta(
                 this.config.data.nickname,
                 this.data.protover,
-                this.data.clientUUID
+                this.data.clientUUID,
+                resume ? this.data.resumeToken : undefined,
+                this.data.lastSeq
             )
         )
     }
 
     connacceptHandler(packet) {
         this.data.isConnected = true;
+        this.data.serverUUID = packet.uuid;
         this.data.checker = setInterval(() => {checkOnline(this.data)}, 100);
+        this.data.resumeToken = packet.resume ?? null;
+        this.data.resumeServer = this.data.connectedTo;
+        this.data.epoch = packet.epoch ?? null;
+        if (this.data.lastSeqServer != this.data.connectedTo || this.data.lastSeqEpoch != this.data.epoch) {
+            // cursor of another server or history, messages here start from seq 1 again
+            this.data.lastSeq = 0;
+            this.data.lastSeqServer = this.data.connectedTo;
+            this.data.lastSeqEpoch = this.data.epoch;
+        }
+        if (packet.resumed) {
+            // missed messages are sent by the server right after connaccept
+            this.data.chat.addMessage(`Подключение к серверу восстановлено.`, "system");
+            return;
+        }
         this.data.chat.addMessage(`Подключено к серверу.`, "system");
-        if (this.config.data.loadServerHistoryFrom > 0) {
+        if (this.data.lastSeq > 0) {
+            this.ws.send(
+                this.data.api.getHistory(
+                    this.data.clientUUID,
+                    this.data.lastSeq,
+                    this.config.data.maxVisibleMessages,
+                    this.data.epoch
+                )
+            )
+        } else if (this.config.data.loadServerHistoryFrom > 0) {
             this.ws.send(
                 this.data.api.getHistory(
                     this.data.clientUUID,
@@ -270,6 +327,7 @@ export class MUCOReceiver {
     }
 
     connrejectHandler(packet) {
+        this.data.resumeToken = null;
         this.data.chat.addMessage(`Ошибка подключения к ${this.data.connectedTo}.`, "system");
         this.data.chat.addMessage(`- ${packet.error}`, "system");
         this.data.isConnected = false;
@@ -279,6 +337,7 @@ export class MUCOReceiver {
     }
 
     conncloseHandler(packet) {
+        this.data.resumeToken = null;
         this.data.chat.addMessage(`Сервер закрыл подключение.`, "system");
         this.data.isConnected = false;
         this.data.serverUUID = null;
@@ -286,7 +345,29 @@ export class MUCOReceiver {
         this.data.checker = null;
     }
 
+    updateLastSeq(seq) {
+        if (seq != undefined && seq > this.data.lastSeq) {
+            this.data.lastSeq = seq;
+            this.data.lastSeqServer = this.data.connectedTo;
+            this.data.lastSeqEpoch = this.data.epoch;
+        }
+    }
+
     historyHandler(packet) {
+        // paged history (has "next" cursor) only contains missed messages, chat is kept
+        if (packet.next != undefined) {
+            // catch-up sends only the newest messages, older missed ones are skipped
+            let skipped = packet.messages.length > 0 && this.data.lastSeq > 0 ? packet.messages[0].seq - this.data.lastSeq - 1 : 0;
+            if (skipped > 0) {
+                this.data.chat.addMessage(`Пропущено сообщений: ${skipped}.`, "system");
+            }
+            for (let msg of packet.messages) {
+                this.data.chat.addMessage(msg.text, msg.author, msg.id);
+            };
+            this.updateLastSeq(packet.next);
+            return;
+        }
+
         this.data.chat.clear();
         if (packet.messages.length > this.config.data.maxVisibleMessages) {
             packet.messages = packet.messages.slice(-this.config.data.maxVisibleMessages)
@@ -295,11 +376,13 @@ export class MUCOReceiver {
         this.data.chat.addMessage("Чат очищен. Загружается история чата сервера...", "system");
         for (let msg of packet.messages) {
             this.data.chat.addMessage(msg.text, msg.author, msg.id);
+            this.updateLastSeq(msg.seq);
         };
     }
 
     messageHandler(packet) {
         this.data.chat.addMessage(packet.text, packet.author, packet.id);
+        this.updateLastSeq(packet.seq);
         if (this.audio.value != null && this.data.wsService.lastsent != packet.id) {
             console.log(this.data.wsService.lastsent, packet.id)
             if (!this.audio.value.paused && !this.audio.value.ended && this.audio.value.currentTime > 0) {
@@ -310,7 +393,15 @@ export class MUCOReceiver {
         }
     }
 
+    // batched messages, sent by servers with batching enabled since connmeta has "batch"
+    messagesHandler(packet) {
+        for (let msg of packet.messages) {
+            this.messageHandler(msg);
+        };
+    }
+
     dconagreeHandler(packet) {
+        this.data.resumeToken = null;
         this.data.chat.addMessage("Отключено от сервера.", "system");
         this.data.isConnected = false;
         this.data.serverUUID = null;
@@ -339,6 +430,7 @@ export class MUCOReceiver {
             case 'connclose': this.conncloseHandler(packet); break;
             case 'history': this.historyHandler(packet); break;
             case 'message': this.messageHandler(packet); break;
+            case 'messages': this.messagesHandler(packet); break;
             case 'dcon-agree': this.dconagreeHandler(packet); break;
             case 'nickchange': this.nickchangeHandler(packet); break;
             default: console.log(`[receiver]: Unknown packet type '${packet.type}'.`)
@@ -0,0 +1,325 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from typing import Awaitable, Callable
+from core import MessageHistory, Room, RoomRegistry
+from msglog import MessageLog
+
+# Snapshot and history lines can be big, messages are up to server_message_size each.
+LINE_LIMIT = 64 * 1024 * 1024
+REQUEST_TIMEOUT = 5.0
+
+# Links the server with other shards. Shard sets the callbacks, backplane calls them for
+# everything that happens globally: on_message(message, room) for every chat message in history order,
+# on_private(touser, author, text) for private messages to its clients and on_media(fileid, media_type)
+# for files stored by other shards.
+class LocalBackplane:
+
+    def __init__(self, history: MessageHistory, rooms: RoomRegistry, log: MessageLog | None = None):
+        self.history = history
+        self.rooms = rooms
+        self.log = log
+        self.on_message: Callable[[dict, str | None], Awaitable] | None = None
+        self.on_private: Callable[[str, str, str], bool] | None = None
+        self.on_media: Callable[[str, str | None], None] | None = None
+
+    async def start(self):
+        if self.log is not None:
+            self.log.open()
+            self.history.restore(self.log.tail(self.history.messages.maxlen))
+            self.history.epoch = self.log.epoch
+            self.log.start()
+
+    async def close(self):
+        if self.log is not None:
+            self.log.close()
+
+    # Room messages are kept only in memory, message log stores the main chat.
+    async def publish(self, text: str, author: str, id: int, room: str | None = None):
+        if room is not None:
+            message = self.rooms.get(room).history.append(text, author, id)
+        else:
+            # Logged first, a failed write must not leave a message in history that the log doesn't have.
+            message = self.history.next(text, author, id)
+            if self.log is not None:
+                self.log.append(message)
+            self.history.add(message)
+        await self.on_message(message, room)
+
+    # Called when the first client of this process joins a room, False if the room can't be created.
+    async def open_room(self, room: Room) -> bool: return True
+
+    def close_room(self, name: str): pass
+
+    # Nickname uniqueness inside one process is kept by ClientRegistry.
+    async def claim(self, nickname: str, uuid: str) -> bool: return True
+
+    def release(self, nickname: str): pass
+
+    # Nickname of a client connected to another shard.
+    async def lookup(self, uuid: str) -> str | None: return None
+
+    # Returns False when nobody on other shards has this nickname.
+    async def private(self, touser: str, author: str, text: str) -> bool: return False
+
+    def media(self, fileid: str, media_type: str | None): pass
+
+# Shard side of the unix socket broker. History is a replica filled by the broker in seq order,
+# messages are published to the broker and broadcast when they come back.
+class UnixBackplane(LocalBackplane):
+
+    def __init__(self, path: str, history: MessageHistory, rooms: RoomRegistry, logger: logging.Logger):
+        super().__init__(history, rooms)
+        self.path = path
+        self.logger = logger
+        self.writer: asyncio.StreamWriter | None = None
+        self.reader_task: asyncio.Task | None = None
+        # request id -> (future, called with the reply as soon as it is read)
+        self.requests: dict[int, tuple[asyncio.Future, Callable[[object], None] | None]] = {}
+        self.next_request = 0
+        # Rooms waiting for the open reply, their messages read before it are in the history it brings.
+        self.opening: set[str] = set()
+
+    async def start(self):
+        reader, self.writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+        while line := await reader.readline():
+            data = json.loads(line)
+            if data["op"] == "ready":
+                self.history.epoch = data["epoch"]
+                break
+            self.history.restore([data["message"]])
+        self.reader_task = asyncio.create_task(self.run(reader))
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    def send(self, **data):
+        self.writer.write(json.dumps(data).encode() + b"\n")
+
+    async def request(self, on_reply: Callable[[object], None] | None = None, **data):
+        self.next_request += 1
+        request = self.next_request
+        future = asyncio.get_running_loop().create_future()
+        self.requests[request] = (future, on_reply)
+        try:
+            self.send(request=request, **data)
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            self.logger.error(f"Backplane request {data['op']} failed: {e or 'timed out'}")
+            return None
+        finally:
+            self.requests.pop(request, None)
+
+    async def run(self, reader: asyncio.StreamReader):
+        try:
+            while line := await reader.readline():
+                data = json.loads(line)
+                op = data["op"]
+                if op == "message":
+                    room = data.get("room")
+                    if room is None:
+                        self.history.restore([data["message"]])
+                    elif room in self.opening:
+                        continue
+                    elif (local := self.rooms.get(room)) is not None:
+                        local.history.restore([data["message"]])
+                    else:
+                        continue
+                    await self.on_message(data["message"], room)
+                elif op == "reply":
+                    pending = self.requests.pop(data["request"], None)
+                    if pending is not None and not pending[0].done():
+                        if pending[1] is not None:
+                            pending[1](data["ok"])
+                        pending[0].set_result(data["ok"])
+                elif op == "private":
+                    self.on_private(data["touser"], data["author"], data["text"])
+                elif op == "media":
+                    self.on_media(data["fileid"], data["media_type"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.error(f"Backplane connection lost: {e}")
+        else:
+            self.logger.error("Backplane connection closed by broker.")
+
+    async def publish(self, text: str, author: str, id: int, room: str | None = None):
+        self.send(op="message", text=text, author=author, id=id, room=room)
+
+    # Stored history is restored when run() reads the reply, before any room message that follows it,
+    # otherwise newer messages could get into the room history before the older stored ones.
+    async def open_room(self, room: Room) -> bool:
+        def opened(stored):
+            self.opening.discard(room.name)
+            if stored is not None:
+                room.history.restore(stored)
+
+        self.opening.add(room.name)
+        try:
+            return await self.request(opened, op="open", room=room.name) is not None
+        finally:
+            self.opening.discard(room.name)
+
+    def close_room(self, name: str): self.send(op="close", room=name)
+
+    async def claim(self, nickname: str, uuid: str) -> bool: return bool(await self.request(op="claim", nickname=nickname, uuid=uuid))
+
+    def release(self, nickname: str): self.send(op="release", nickname=nickname)
+
+    async def lookup(self, uuid: str) -> str | None: return await self.request(op="lookup", uuid=uuid)
+
+    async def private(self, touser: str, author: str, text: str) -> bool:
+        return bool(await self.request(op="private", touser=touser, author=author, text=text))
+
+    def media(self, fileid: str, media_type: str | None): self.send(op="media", fileid=fileid, media_type=media_type)
+
+# Owns global state of a sharded server: the ordered history (and message log), nicknames of all
+# shards, and routes messages between shards. Runs in the supervisor process on its own thread.
+class Broker:
+
+    def __init__(
+            self,
+            path: str,
+            history: MessageHistory,
+            log: MessageLog | None,
+            logger: logging.Logger,
+            rooms_max: int = 64,
+            room_history_size: int = 256
+    ):
+        self.path = path
+        self.history = history
+        self.log = log
+        self.logger = logger
+        self.rooms_max = rooms_max
+        self.room_history_size = room_history_size
+        self.shards: set[asyncio.StreamWriter] = set()
+        # room -> (history, shards having members in it), a room lives while any shard has it open
+        self.rooms: dict[str, tuple[MessageHistory, set[asyncio.StreamWriter]]] = {}
+        # nickname -> (shard connection owning it, client uuid)
+        self.nicknames: dict[str, tuple[asyncio.StreamWriter, str]] = {}
+        self.uuids: dict[str, str] = {}
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: threading.Thread | None = None
+        self.stopped: asyncio.Event | None = None
+
+    def start(self):
+        ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self.serve(ready),), daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+        self.thread.join(5)
+
+    async def serve(self, ready: threading.Event):
+        self.stopped = asyncio.Event()
+        if self.log is not None:
+            self.log.open()
+            self.history.restore(self.log.tail(self.history.messages.maxlen))
+            self.history.epoch = self.log.epoch
+            self.log.start()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        server = await asyncio.start_unix_server(self.handle, self.path, limit=LINE_LIMIT)
+        self.logger.info(f"Backplane broker listening on {self.path} ({len(self.history)} messages, last seq is {self.history.seq}).")
+        ready.set()
+        await self.stopped.wait()
+
+        server.close()
+        for x in tuple(self.shards):
+            x.close()
+        if self.log is not None:
+            self.log.close()
+        os.remove(self.path)
+
+    def release(self, writer: asyncio.StreamWriter, nickname: str):
+        owner = self.nicknames.get(nickname)
+        if owner is not None and owner[0] is writer:
+            del self.nicknames[nickname]
+            if self.uuids.get(owner[1]) == nickname:
+                del self.uuids[owner[1]]
+
+    def close_room(self, writer: asyncio.StreamWriter, name: str):
+        room = self.rooms.get(name)
+        if room is not None:
+            room[1].discard(writer)
+            if not room[1]:
+                del self.rooms[name]
+
+    @staticmethod
+    def encode(**data): return json.dumps(data).encode() + b"\n"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        for message in self.history:
+            writer.write(self.encode(op="message", message=message))
+        writer.write(self.encode(op="ready", epoch=self.history.epoch))
+        self.shards.add(writer)
+        self.logger.debug(f"Shard connected to backplane ({len(self.shards)} total).")
+
+        try:
+            while line := await reader.readline():
+                data = json.loads(line)
+                op = data["op"]
+                if op == "message":
+                    room = data.get("room")
+                    if room is None:
+                        message = self.history.next(data["text"], data["author"], data["id"])
+                        if self.log is not None:
+                            self.log.append(message)
+                        self.history.add(message)
+                        targets = self.shards
+                    elif room in self.rooms:
+                        history, targets = self.rooms[room]
+                        message = history.append(data["text"], data["author"], data["id"])
+                    else:
+                        continue
+                    frame = self.encode(op="message", message=message, room=room)
+                    for x in targets:
+                        x.write(frame)
+                elif op == "open":
+                    room = self.rooms.get(data["room"])
+                    if room is None and len(self.rooms) < self.rooms_max:
+                        room = self.rooms[data["room"]] = (MessageHistory(self.room_history_size), set())
+                    if room is not None:
+                        room[1].add(writer)
+                    writer.write(self.encode(op="reply", request=data["request"], ok=None if room is None else list(room[0])))
+                elif op == "close":
+                    self.close_room(writer, data["room"])
+                elif op == "claim":
+                    ok = data["nickname"] not in self.nicknames
+                    if ok:
+                        self.nicknames[data["nickname"]] = (writer, data["uuid"])
+                        self.uuids[data["uuid"]] = data["nickname"]
+                    writer.write(self.encode(op="reply", request=data["request"], ok=ok))
+                elif op == "release":
+                    self.release(writer, data["nickname"])
+                elif op == "lookup":
+                    writer.write(self.encode(op="reply", request=data["request"], ok=self.uuids.get(data["uuid"])))
+                elif op == "private":
+                    owner = self.nicknames.get(data["touser"])
+                    if owner is not None:
+                        owner[0].write(self.encode(op="private", touser=data["touser"], author=data["author"], text=data["text"]))
+                    writer.write(self.encode(op="reply", request=data["request"], ok=owner is not None))
+                elif op == "media":
+                    frame = self.encode(op="media", fileid=data["fileid"], media_type=data["media_type"])
+                    for x in self.shards:
+                        if x is not writer:
+                            x.write(frame)
+        except (ConnectionError, json.JSONDecodeError) as e:
+            self.logger.error(f"Shard connection failed: {e}")
+        finally:
+            self.shards.discard(writer)
+            for nickname in [k for k, v in self.nicknames.items() if v[0] is writer]:
+                self.release(writer, nickname)
+            for room in [k for k, v in self.rooms.items() if writer in v[1]]:
+                self.close_room(writer, room)
+            writer.close()
+            self.logger.debug(f"Shard disconnected from backplane ({len(self.shards)} left).")
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from core import Message, SharedPacket
+
+class FakeWebSocket:
+
+    async def send_text(self, data: str):
+        pass
+
+class FakeClient:
+
+    def __init__(self):
+        self.ws = FakeWebSocket()
+        self.server_uuid = str(uuid.uuid4())
+
+async def broadcast_per_client(clients: list[FakeClient], text: str, author: str, id: int):
+    await asyncio.gather(
+        *[x.ws.send_text(Message(x.server_uuid, text, author, id).wsPacket) for x in clients],
+        return_exceptions=True
+    )
+
+async def broadcast_shared(clients: list[FakeClient], text: str, author: str, id: int):
+    packet = SharedPacket("message", text=text, author=author, id=id)
+    await asyncio.gather(
+        *[x.ws.send_text(packet.wsPacketFor(x.server_uuid)) for x in clients],
+        return_exceptions=True
+    )
+
+async def run(func, clients: list[FakeClient], text: str, rounds: int):
+    start = time.perf_counter()
+    for i in range(rounds):
+        await func(clients, text, "benchmark", i)
+    return rounds / (time.perf_counter() - start)
+
+async def main():
+    text = "Привет, это тестовое сообщение для бенчмарка рассылки. " * 4
+    for size in (10, 100, 1000):
+        clients = [FakeClient() for _ in range(size)]
+        rounds = max(20, 20000 // size)
+
+        before = await run(broadcast_per_client, clients, text, rounds)
+        after = await run(broadcast_shared, clients, text, rounds)
+        print(f"{size:>5} clients: before {before:>10.1f} msg/s, after {after:>10.1f} msg/s ({after / before:.2f}x)")
+
+if __name__ == "__main__":
+    asyncio.run(main())
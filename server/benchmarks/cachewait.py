@@ -0,0 +1,45 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from mediacache import MediaCache
+
+async def main(waiters: int = 1000):
+    directory = tempfile.mkdtemp(prefix="muco-cache-")
+    try:
+        media = MediaCache(directory)
+        media.start()
+
+        content = os.urandom(64 * 1024)
+        fileid = hashlib.sha256(content).hexdigest()
+        woke = []
+
+        async def request():
+            if await media.wait(fileid, 30):
+                woke.append(time.perf_counter())
+
+        tasks = [asyncio.create_task(request()) for _ in range(waiters)]
+        await asyncio.sleep(0.5)
+
+        with open(media.path(fileid), "wb") as f:
+            f.write(content)
+        published = time.perf_counter()
+        media.ready(fileid)
+        await asyncio.gather(*tasks)
+
+        assert len(woke) == waiters and not media.pending
+        print(f"{waiters} waiting requests resolved {(max(woke) - published) * 1000:.2f}ms after upload finished (was up to 1000ms with polling)")
+
+        start = time.perf_counter()
+        missing = await asyncio.gather(*[media.wait("0" * 64, 0.2) for _ in range(waiters)])
+        print(f"{waiters} requests for missing file timed out after {(time.perf_counter() - start) * 1000:.0f}ms, all 404: {not any(missing)}")
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import core
+from codec import CODECS
+from core import Packet
+
+def samples() -> list[Packet]:
+    server_uuid = str(uuid.uuid4())
+    text = "Привет, это тестовое сообщение для бенчмарка кодеков. <img src=\"http://127.0.0.1:5656/cached/" + "a" * 64 + "\"> " * 2
+    history = [{"text": text, "author": f"user{i}", "id": 1700000000 + i, "seq": i} for i in range(128)]
+    return [
+        core.ConnectionMeta(server_uuid, "0.1.82", "server"),
+        core.ConnectionAccept(server_uuid),
+        core.ConnectionReject(server_uuid, "nickname already taken, change nickname"),
+        core.ConnectionClose(server_uuid),
+        core.Disconnect(server_uuid),
+        core.DisconnectionAgree(server_uuid),
+        core.GetHistory(server_uuid, 100, 128),
+        core.History(server_uuid, history, next=127, more=False),
+        core.JoinRoom(server_uuid, "game1"),
+        core.LeaveRoom(server_uuid, "game1"),
+        core.Messages(server_uuid, history[:16]),
+        core.Message(server_uuid, text, "user", 1700000000),
+        core.NicknameChange(server_uuid, "newnick")
+    ]
+
+def rate(func, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return rounds / (time.perf_counter() - start)
+
+# Packet.wsPacket before codecs: merged dict dumped with json.dumps, parsed back with json.loads and pops.
+def legacy_decode(frame: str):
+    data = json.loads(frame)
+    datatype = data.pop("type")
+    client_uuid = data.pop("uuid")
+    return Packet(datatype, client_uuid, **data)
+
+def main(rounds: int = 20000):
+    print(f"{'packet':<20} {'codec':<8} {'bytes':>7} {'encode/s':>12} {'decode/s':>12}")
+    for packet in samples():
+        count = max(200, rounds // (100 if packet.type == "history" else 1))
+        legacy = json.dumps({"type": packet.type, "uuid": packet.uuid, **packet.content})
+        print(
+            f"{type(packet).__name__:<20} {'legacy':<8} {len(legacy.encode()):>7} "
+            f"{rate(lambda: json.dumps({'type': packet.type, 'uuid': packet.uuid, **packet.content}), count):>12.0f} "
+            f"{rate(lambda: legacy_decode(legacy), count):>12.0f}"
+        )
+        for codec in CODECS.values():
+            frame = packet.encode(codec)
+            assert (Packet.decode(None, frame) if codec.binary else Packet.decode(frame)).content == packet.content
+            encode = rate(lambda: packet.encode(codec), count)
+            decode = rate((lambda: Packet.decode(None, frame)) if codec.binary else (lambda: Packet.decode(frame)), count)
+            size = len(frame) if codec.binary else len(frame.encode())
+            print(f"{'':<20} {codec.name:<8} {size:>7} {encode:>12.0f} {decode:>12.0f}")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
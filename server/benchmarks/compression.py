@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import Frame, Opcode
+from compression import compress
+from core import ClientData, SharedPacket
+
+class FakeClient(ClientData):
+
+    def __init__(self, compression: tuple[int, int] | None):
+        super().__init__(None, str(uuid.uuid4()), str(uuid.uuid4()))
+        self.compress = compression
+
+def chat(count: int) -> list[dict]:
+    return [
+        {"text": f"<p>Сообщение {i}: <img src=\"http://127.0.0.1:5656/cached/{i:064x}\"> немного текста чата</p>" * 3, "author": f"user{i % 20}", "id": 1700000000 + i, "seq": i}
+        for i in range(count)
+    ]
+
+def permessage_deflate(clients, messages, takeover: bool, level: int, window_bits: int):
+    extensions = [PerMessageDeflate(False, not takeover, 15, window_bits, {"level": level}) for _ in clients]
+    total = 0
+    for message in messages:
+        packet = SharedPacket("message", **message)
+        for x, extension in zip(clients, extensions):
+            total += len(extension.encode(Frame(Opcode.TEXT, packet.frameFor(x).encode())).data)
+    return total
+
+def frames(clients, messages):
+    total = 0
+    for message in messages:
+        packet = SharedPacket("message", **message)
+        for x in clients:
+            frame = packet.frameFor(x)
+            total += len(frame) if isinstance(frame, bytes) else len(frame.encode())
+    return total
+
+def per_client(clients, messages, level: int):
+    total = 0
+    for message in messages:
+        packet = SharedPacket("message", **message)
+        for x in clients:
+            total += len(compress(packet.frameFor(x), level))
+    return total
+
+def measure(name: str, func, *args):
+    start = time.process_time()
+    size = func(*args)
+    elapsed = time.process_time() - start
+    print(f"{name:<44} {size / 1024:>10.0f} KiB {elapsed * 1000:>9.0f} ms cpu")
+
+def main(size: int = 200, count: int = 50):
+    messages = chat(count)
+    print(f"broadcast of {count} messages to {size} clients")
+    measure("none", frames, [FakeClient(None) for _ in range(size)], messages)
+    for level in (1, 6, 9):
+        measure(f"permessage-deflate, takeover, level {level}", permessage_deflate, [FakeClient(None) for _ in range(size)], messages, True, level, 15)
+    measure("permessage-deflate, no takeover, level 6", permessage_deflate, [FakeClient(None) for _ in range(size)], messages, False, 6, 15)
+    measure("permessage-deflate, takeover, 10 bit window", permessage_deflate, [FakeClient(None) for _ in range(size)], messages, True, 6, 10)
+    measure("app, compressed per client, level 6", per_client, [FakeClient(None) for _ in range(size)], messages, 6)
+    for level in (1, 6):
+        measure(f"app, shared compressed, level {level}", frames, [FakeClient((0, level)) for _ in range(size)], messages)
+    measure("app, shared compressed, level 6, from 1 KiB", frames, [FakeClient((1024, 6)) for _ in range(size)], messages)
+
+if __name__ == "__main__":
+    main(*(int(x) for x in sys.argv[1:3]))
@@ -0,0 +1,40 @@
+import asyncio
+import base64
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from mediacache import LEGACY_PARSER, MediaCache
+
+def url(fileid: str): return f"http://127.0.0.1:5656/cached/{fileid}"
+
+async def run(name: str, func, rounds: int):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        text = await func()
+    elapsed = (time.perf_counter() - start) / rounds
+    print(f"{name:>9}: {elapsed * 1000:8.2f}ms per message, result is {len(text)} chars")
+
+async def main(size: int = 1024 * 1024, rounds: int = 20):
+    directory = tempfile.mkdtemp(prefix="muco-extract-")
+    try:
+        media = MediaCache(directory)
+        media.start()
+
+        payload = base64.b64encode(os.urandom(size * 3 // 4)).decode()
+        text = f'<p>Смотрите</p><img src="data:image/png;base64,{payload}" alt="meme"> и подпись'
+        print(f"message with {len(payload)} chars of base64:")
+
+        await run("extractor", lambda: media.extract(text, url, 64 * 1024 * 1024), rounds)
+        if LEGACY_PARSER:
+            await run("bs4+lxml", lambda: asyncio.to_thread(media.extract_legacy, text, url), rounds)
+        else:
+            print("bs4+lxml: not installed, skipped")
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1024 * 1024))
@@ -0,0 +1,80 @@
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from codec import CODECS
+from compression import compress
+from core import ClientData, History, MessageHistory
+
+class FakeClient(ClientData):
+
+    def __init__(self, codec, compress: tuple[int, int] | None):
+        super().__init__(None, str(uuid.uuid4()), str(uuid.uuid4()))
+        self.codec = codec
+        self.compress = compress
+
+def filled(size: int) -> MessageHistory:
+    history = MessageHistory(size)
+    for i in range(size):
+        history.append(f"<p>Сообщение номер {i}, немного текста для объема.</p>", f"user{i % 100}", 1700000000 + i)
+    return history
+
+# What getHistory did before: the whole history encoded for every requester.
+def current(history: MessageHistory, client: ClientData):
+    frame = History(client.server_uuid, list(history)).encode(client.codec)
+    if client.compress is not None and len(frame) >= client.compress[0]:
+        frame = compress(frame, client.compress[1])
+    return frame
+
+def cached(history: MessageHistory, client: ClientData):
+    return history.snapshot().frameFor(client)
+
+# Join wave: every client asks for the whole history, a new message arrives every `every` requests.
+def wave(func, history: MessageHistory, clients: list[ClientData], every: int):
+    for i, client in enumerate(clients):
+        if every and i % every == 0:
+            history.append("<p>Новое сообщение</p>", "user", 1800000000 + i)
+        func(history, client)
+
+# Starts from a history nobody asked for yet, so the cached path pays for encoding the segments too.
+# CPU is measured without tracemalloc, it slows allocations down a lot.
+def measure(func, size: int, clients: list[ClientData], every: int) -> tuple[float, int, int]:
+    history = filled(size)
+    gc.collect()
+    gc.disable()
+    start = time.process_time()
+    wave(func, history, clients, every)
+    cpu = time.process_time() - start
+    gc.enable()
+
+    history = filled(size)
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    wave(func, history, clients, every)
+    current_size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Retained: what the history keeps besides messages (encoded segments, cached packet).
+    return cpu, peak - base, current_size - base
+
+def main(count: int = 100, size: int = 1024):
+    print(f"join wave of {count} clients, history of {size} messages, CPU time and traced memory")
+    print(f"{'':<34} {'cpu current':>12} {'cpu cached':>11} {'peak current':>13} {'peak cached':>12} {'retained':>9}")
+    for name, codec in CODECS.items():
+        for level in (None, (1024, 6)):
+            clients = [FakeClient(codec, level) for _ in range(count)]
+            for every in (0, 10, 1):
+                label = f"{name}{', compressed' if level else ''}, {'no appends' if not every else f'append / {every}'}"
+                before = measure(current, size, clients, every)
+                after = measure(cached, size, clients, every)
+                print(
+                    f"{label:<34} {before[0] * 1000:>9.1f} ms {after[0] * 1000:>8.1f} ms"
+                    f" {before[1] / 1024:>10.0f} KB {after[1] / 1024:>9.0f} KB {after[2] / 1024:>6.0f} KB"
+                )
+
+if __name__ == "__main__":
+    main(*(int(x) for x in sys.argv[1:3]))
@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import urllib.request
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import websockets
+from core import Packet
+
+# Load generator speaking the real overlay protocol (connmeta -> connaccept -> getHistory -> message)
+# to a running server. All simulated clients come from one IP, so run the server with relaxed rate limits
+# ("rate_limits": {} and "rate_limits_ip": {} in muco-server.json), dropped packets are reported as "limited".
+# Server CPU and RSS are read from /proc for the worker pid from /stats (Linux, same machine only).
+
+# Nicknames are unique per run, parked sessions of a previous run may still hold the old ones.
+RUN = uuid.uuid4().hex[:6]
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def summary(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": None if not values else percentile(values, 0.5) * 1000,
+        "p99_ms": None if not values else percentile(values, 0.99) * 1000,
+        "max_ms": None if not values else max(values) * 1000
+    }
+
+class ServerProcess:
+
+    def __init__(self, http: str):
+        self.http = http
+        self.pid = None
+        self.rss_peak = 0
+        self.sampler: asyncio.Task | None = None
+        self.cpu_start = 0.0
+
+    def stats(self) -> dict:
+        with urllib.request.urlopen(f"{self.http}stats") as f:
+            return json.load(f)
+
+    def cpu(self) -> float | None:
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, TypeError):
+            return None
+
+    def rss(self) -> int | None:
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, TypeError):
+            return None
+
+    async def sample(self):
+        while True:
+            self.rss_peak = max(self.rss_peak, self.rss() or 0)
+            await asyncio.sleep(0.1)
+
+    async def start(self):
+        self.pid = (await asyncio.to_thread(self.stats))["worker"]
+        self.rss_peak = 0
+        self.cpu_start = self.cpu() or 0.0
+        self.sampler = asyncio.create_task(self.sample())
+
+    async def stop(self, elapsed: float) -> dict:
+        self.sampler.cancel()
+        cpu = self.cpu()
+        rss = self.rss()
+        return {
+            "pid": self.pid,
+            "cpu_s": None if cpu is None else cpu - self.cpu_start,
+            "cpu_percent": None if cpu is None else (cpu - self.cpu_start) / elapsed * 100,
+            "rss_bytes": rss,
+            "rss_peak_bytes": max(self.rss_peak, rss or 0) or None
+        }
+
+class SimClient:
+
+    def __init__(self, url: str, nickname: str, batch: bool):
+        self.url = url
+        self.nickname = nickname
+        self.batch = batch
+        self.uuid = str(uuid.uuid4())
+        self.ws = None
+        self.server_uuid = None
+        self.token = None
+        self.seq = 0
+        self.reader: asyncio.Task | None = None
+        self.history = asyncio.Event()
+        self.limited = 0
+
+    async def recv(self) -> Packet:
+        frame = await self.ws.recv()
+        return Packet.decode(frame) if isinstance(frame, str) else Packet.decode(None, frame)
+
+    # Returns connaccept or connreject packet.
+    async def connect(self, history: bool = True, resume: bool = False) -> Packet:
+        self.history.clear()
+        self.ws = await websockets.connect(self.url, max_size=None)
+        meta = await self.recv()
+        if meta.type != "connmeta":
+            return meta
+        options = {"batch": True} if self.batch else {}
+        if resume and self.token is not None:
+            options.update({"token": self.token, "from": self.seq})
+        await self.ws.send(Packet("connmeta", self.uuid, nickname=self.nickname, version=meta["version"], resume=True, **options).wsPacket)
+        reply = await self.recv()
+        if reply.type == "connaccept":
+            self.server_uuid = reply.uuid
+            self.token = reply.content.get("resume")
+            # Resumed session gets missed messages as history without asking.
+            if history and not reply.content.get("resumed"):
+                await self.ws.send(Packet("getHistory", self.uuid).wsPacket)
+        return reply
+
+    async def send(self, text: str, id: int):
+        await self.ws.send(Packet("message", self.uuid, text=text, author=self.nickname, id=id).wsPacket)
+
+    def read(self, on_message):
+        self.reader = asyncio.create_task(self.run(on_message))
+
+    async def run(self, on_message):
+        try:
+            while True:
+                packet = await self.recv()
+                if packet.type == "message":
+                    if "seq" not in packet.content:
+                        # Server notice, rate limit ones are counted.
+                        if packet["text"].startswith("Слишком много запросов"):
+                            self.limited += 1
+                    else:
+                        self.seq = max(self.seq, packet.content.get("seq", 0))
+                        on_message(packet.content)
+                elif packet.type == "messages":
+                    for x in packet["messages"]:
+                        self.seq = max(self.seq, x["seq"])
+                        on_message(x)
+                elif packet.type == "history":
+                    for x in packet["messages"]:
+                        self.seq = max(self.seq, x.get("seq", 0))
+                    if not packet.content.get("more"):
+                        self.history.set()
+        except (websockets.ConnectionClosed, asyncio.CancelledError):
+            pass
+
+    # Polite disconnect, otherwise a resumable session stays parked on the server.
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.ws.state == websockets.State.OPEN:
+            await self.ws.send(Packet("disconnect", self.uuid).wsPacket)
+        await self.ws.close()
+
+# Setup connections, done in waves to stay under the server's handshake_max_pending.
+async def connect_all(url: str, count: int, batch: bool, prefix: str, wave: int = 32) -> list[SimClient]:
+    clients = [SimClient(url, f"{prefix}{i}-{RUN}", batch) for i in range(count)]
+    replies = []
+    for i in range(0, count, wave):
+        replies += await asyncio.gather(*(x.connect() for x in clients[i:i + wave]))
+    rejected = [x.content.get("error") for x in replies if x.type != "connaccept"]
+    if rejected:
+        raise RuntimeError(f"{len(rejected)} clients rejected: {rejected[0]}")
+    return clients
+
+# Every client sends messages, latency is from send to delivery at every recipient.
+async def burst(args, server: ServerProcess) -> dict:
+    clients = await connect_all(args.url, args.clients, args.batch, "burst")
+    sent: dict[int, float] = {}
+    latencies: list[float] = []
+    expected = args.clients * args.messages * args.clients
+    done = asyncio.Event()
+
+    def on_message(message):
+        start = sent.get(message["id"])
+        if start is not None:
+            latencies.append(time.perf_counter() - start)
+            if len(latencies) >= expected:
+                done.set()
+
+    for x in clients:
+        x.read(on_message)
+    await asyncio.gather(*(x.history.wait() for x in clients))
+
+    base = int(time.time() * 1000) * 1000
+    await server.start()
+    start = time.perf_counter()
+
+    async def talk(index: int, client: SimClient):
+        for i in range(args.messages):
+            id = base + index * args.messages + i
+            sent[id] = time.perf_counter()
+            await client.send(f"<p>Сообщение {i} от {client.nickname}</p>", id)
+            if args.interval > 0:
+                await asyncio.sleep(args.interval)
+
+    await asyncio.gather(*(talk(i, x) for i, x in enumerate(clients)))
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+    result = {
+        "sent": len(sent),
+        "delivered": len(latencies),
+        "expected": expected,
+        "elapsed_s": elapsed,
+        "messages_per_s": len(sent) / elapsed,
+        "deliveries_per_s": len(latencies) / elapsed,
+        "latency": summary(latencies),
+        "limited": sum(x.limited for x in clients),
+        "server": await server.stop(elapsed)
+    }
+    await asyncio.gather(*(x.close() for x in clients))
+    return result
+
+# Every client loses its connection at once and reconnects, resuming the session if --resume is given.
+async def reconnect(args, server: ServerProcess) -> dict:
+    clients = await connect_all(args.url, args.clients, args.batch, "storm")
+    for x in clients:
+        x.read(lambda message: None)
+    await asyncio.gather(*(x.history.wait() for x in clients))
+    for x in clients:
+        x.reader.cancel()
+        x.ws.transport.abort()
+    await asyncio.sleep(args.interval)
+
+    times: list[float] = []
+    rejected: dict[str, int] = {}
+    await server.start()
+    start = time.perf_counter()
+
+    async def again(client: SimClient):
+        begin = time.perf_counter()
+        try:
+            reply = await client.connect(resume=args.resume)
+        except (OSError, websockets.WebSocketException) as e:
+            rejected[type(e).__name__] = rejected.get(type(e).__name__, 0) + 1
+            return
+        if reply.type != "connaccept":
+            rejected[reply["error"]] = rejected.get(reply["error"], 0) + 1
+            return
+        client.read(lambda message: None)
+        await client.history.wait()
+        times.append(time.perf_counter() - begin)
+
+    await asyncio.gather(*(again(x) for x in clients))
+    elapsed = time.perf_counter() - start
+    result = {
+        "reconnected": len(times),
+        "rejected": rejected,
+        "elapsed_s": elapsed,
+        "reconnects_per_s": len(times) / elapsed,
+        "latency": summary(times),
+        "server": await server.stop(elapsed)
+    }
+    await asyncio.gather(*(x.close() for x in clients), return_exceptions=True)
+    return result
+
+# History is filled first, then all clients join at once and load the whole history.
+async def history(args, server: ServerProcess) -> dict:
+    (writer,) = await connect_all(args.url, 1, False, "filler")
+    writer.read(lambda message: None)
+    base = int(time.time() * 1000) * 1000
+    for i in range(args.messages):
+        await writer.send(f"<p>История {i}: " + "текст " * 20 + "</p>", base + i)
+    await asyncio.sleep(0.5)
+
+    times: list[float] = []
+    rejected: dict[str, int] = {}
+    await server.start()
+    start = time.perf_counter()
+
+    async def join(index: int) -> SimClient:
+        client = SimClient(args.url, f"joiner{index}-{RUN}", args.batch)
+        begin = time.perf_counter()
+        reply = await client.connect()
+        if reply.type != "connaccept":
+            rejected[reply["error"]] = rejected.get(reply["error"], 0) + 1
+            return client
+        client.read(lambda message: None)
+        await client.history.wait()
+        times.append(time.perf_counter() - begin)
+        return client
+
+    clients = await asyncio.gather(*(join(i) for i in range(args.clients)))
+    elapsed = time.perf_counter() - start
+    result = {
+        "history_messages": args.messages,
+        "joined": len(times),
+        "rejected": rejected,
+        "elapsed_s": elapsed,
+        "joins_per_s": len(times) / elapsed,
+        "latency": summary(times),
+        "limited": writer.limited,
+        "server": await server.stop(elapsed)
+    }
+    await asyncio.gather(*(x.close() for x in (writer, *clients)), return_exceptions=True)
+    return result
+
+def upload_file(http: str, client_id: str, data: bytes) -> int:
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"clientId\"\r\n\r\n{client_id}\r\n"
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"load.png\"\r\nContent-Type: image/png\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    request = urllib.request.Request(f"{http}upload", body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    with urllib.request.urlopen(request) as f:
+        return f.status
+
+# Clients upload distinct files over HTTP at the same time.
+async def upload(args, server: ServerProcess) -> dict:
+    clients = await connect_all(args.url, args.clients, args.batch, "uploader")
+    times: list[float] = []
+    failed = 0
+    await server.start()
+    start = time.perf_counter()
+
+    async def send(client: SimClient):
+        nonlocal failed
+        for _ in range(args.messages):
+            data = os.urandom(args.size)
+            begin = time.perf_counter()
+            try:
+                await asyncio.to_thread(upload_file, args.http, client.uuid, data)
+            except OSError:
+                failed += 1
+                continue
+            times.append(time.perf_counter() - begin)
+
+    await asyncio.gather(*(send(x) for x in clients))
+    elapsed = time.perf_counter() - start
+    result = {
+        "uploaded": len(times),
+        "failed": failed,
+        "file_bytes": args.size,
+        "elapsed_s": elapsed,
+        "bytes_per_s": len(times) * args.size / elapsed,
+        "latency": summary(times),
+        "server": await server.stop(elapsed)
+    }
+    await asyncio.gather(*(x.close() for x in clients))
+    return result
+
+SCENARIOS = {"burst": burst, "reconnect": reconnect, "history": history, "upload": upload}
+
+async def main(args):
+    args.http = "http" + args.url[2:].rstrip("/") + "/"
+    server = ServerProcess(args.http)
+    results = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "url": args.url,
+        "clients": args.clients,
+        "batch": args.batch,
+        "scenarios": {}
+    }
+    for name in args.scenarios or SCENARIOS:
+        print(f"Running {name}...", file=sys.stderr)
+        results["scenarios"][name] = await SCENARIOS[name](args, server)
+        await asyncio.sleep(args.interval + 0.5)
+
+    output = json.dumps(results, indent=4, ensure_ascii=False)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for a running MUCO server.")
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)}, all if not set")
+    parser.add_argument("--url", default="ws://127.0.0.1:5656/")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20, help="messages per client (burst), history size (history), files per client (upload)")
+    parser.add_argument("--interval", type=float, default=0.0, help="pause between messages (burst), offline time (reconnect)")
+    parser.add_argument("--size", type=int, default=256 * 1024, help="uploaded file size")
+    parser.add_argument("--batch", action="store_true", help="clients ask for batched delivery")
+    parser.add_argument("--resume", action="store_true", help="reconnect storm resumes sessions")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--output", help="JSON file, stdout if not set")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario '{name}'")
+    asyncio.run(main(args))
@@ -0,0 +1,75 @@
+import gc
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from core import ClientData, Packet, RateLimiter, SharedPacket
+from metrics import Metrics
+
+class FakeClient(ClientData):
+
+    def __init__(self):
+        super().__init__(None, str(uuid.uuid4()), str(uuid.uuid4()))
+
+def fanout(clients, count: int, metrics: Metrics | None):
+    for i in range(count):
+        broadcast(clients, f"<p>Сообщение {i}</p>", i, metrics)
+        for x in clients:
+            x.outbox.clear()
+
+# Same as server.broadcast for clients without batching.
+def broadcast(clients, text: str, seq: int, metrics: Metrics | None):
+    start = time.perf_counter()
+    packet = None
+    sent = 0
+    for x in clients:
+        if packet is None:
+            packet = SharedPacket("message", text=text, author="user", id=1700000000 + seq, seq=seq)
+        x.send(packet.frameFor(x))
+        sent += 1
+    if metrics is not None and sent:
+        metrics.fanout["immediate"].observe(time.perf_counter() - start)
+        metrics.frames += sent
+
+# Per frame work of the handler for a chat message: decode, rate limits, broadcast.
+def message_path(clients, frames, metrics: Metrics | None):
+    limiter = RateLimiter({"*": (1e9, 10 ** 9)})
+    ip_limiter = RateLimiter({"*": (1e9, 10 ** 9)})
+    for seq, frame in enumerate(frames):
+        packet = Packet.decode(frame)
+        if metrics is not None:
+            metrics.packet(packet.type)
+        now = time.monotonic()
+        if limiter.allow(packet.type, now) and ip_limiter.allow(packet.type, now):
+            broadcast(clients, packet["text"], seq, metrics)
+        for x in clients:
+            x.outbox.clear()
+
+# Best of several runs, instrumented and plain runs interleaved so CPU frequency changes hit both.
+def compare(name: str, func, *args, runs: int = 40):
+    plain = instrumented = float("inf")
+    gc.disable()
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(*args, None)
+        plain = min(plain, time.perf_counter() - start)
+        start = time.perf_counter()
+        func(*args, Metrics())
+        instrumented = min(instrumented, time.perf_counter() - start)
+    gc.enable()
+    print(f"{name:<36} {plain * 1000:>9.1f} ms {instrumented * 1000:>9.1f} ms {(instrumented / plain - 1) * 100:>+8.2f}%")
+
+def main(size: int = 200, count: int = 100):
+    print(f"{'':<36} {'plain':>12} {'metrics':>12} {'overhead':>9}")
+    compare(f"fan-out, {count} messages x {size}", fanout, [FakeClient() for _ in range(size)], count)
+    compare(f"fan-out, {count * 20} messages x 10", fanout, [FakeClient() for _ in range(10)], count * 20)
+    frames = [
+        Packet("message", str(uuid.uuid4()), text=f"<p>Сообщение {i}</p>", author="user", id=1700000000 + i).wsPacket
+        for i in range(count * 20)
+    ]
+    compare(f"message path, {len(frames)} x 10", message_path, [FakeClient() for _ in range(10)], frames)
+
+if __name__ == "__main__":
+    main(*(int(x) for x in sys.argv[1:3]))
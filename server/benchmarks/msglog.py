@@ -0,0 +1,44 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from core import MessageHistory
+from msglog import MessageLog
+
+def main(count: int = 1_000_000, history_size: int = 1024):
+    directory = tempfile.mkdtemp(prefix="muco-msglog-")
+    try:
+        history = MessageHistory(history_size)
+        log = MessageLog(directory, retention_segments=1 << 16)
+        log.open()
+
+        start = time.perf_counter()
+        for i in range(count):
+            message = history.append(f"Сообщение номер {i}, немного текста для объема.", f"user{i % 100}", i)
+            log.append(message)
+            if i % 10000 == 0:
+                log.sync()
+        log.close()
+        elapsed = time.perf_counter() - start
+
+        size = sum(os.path.getsize(os.path.join(directory, x)) for x in os.listdir(directory))
+        print(f"append: {count} messages in {elapsed:.2f}s ({count / elapsed:.0f} msg/s, {size / 1024 / 1024:.1f} MiB, fsync every 10000)")
+
+        start = time.perf_counter()
+        restored = MessageHistory(history_size)
+        log = MessageLog(directory, retention_segments=1 << 16)
+        log.open()
+        restored.restore(log.tail(history_size))
+        log.close()
+        elapsed = time.perf_counter() - start
+
+        assert restored.seq == count and len(restored) == min(count, history_size)
+        print(f"restart: restored last {len(restored)} messages in {elapsed * 1000:.1f}ms")
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
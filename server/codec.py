@@ -0,0 +1,163 @@
+import json
+from json.encoder import encode_basestring_ascii
+from compression import COMPRESSED, inflate
+
+try:
+    import orjson
+    FAST_JSON = True
+except ImportError:
+    FAST_JSON = False
+
+try:
+    import msgpack
+    MSGPACK = True
+except ImportError:
+    MSGPACK = False
+
+# encode_basestring_ascii is the C string encoder behind json.dumps, much cheaper than a dumps call.
+def string(value) -> str:
+    return encode_basestring_ascii(value) if isinstance(value, str) else json.dumps(value)
+
+# Codecs write a packet straight from its parts, the {"type", "uuid", **content} dict is never built.
+# Shared packets (same content for many clients, only uuid differs) are encoded once into head and
+# tail fragments, recipient's uuid is spliced between them.
+class JSONCodec:
+
+    name = "json"
+    binary = False
+
+    # Same output as json.dumps({"type": type, "uuid": uuid, **content}).
+    def encode(self, type: str, uuid: str, content: dict) -> str:
+        if not content:
+            return '{"type": ' + string(type) + ', "uuid": ' + string(uuid) + "}"
+        return '{"type": ' + string(type) + ', "uuid": ' + string(uuid) + ", " + json.dumps(content)[1:]
+
+    def fragments(self, type: str, content: dict) -> tuple[str, str]:
+        return '{"type": ' + string(type) + ', "uuid": "', '"' + (", " + json.dumps(content)[1:] if content else "}")
+
+    # uuid must be JSON-safe as is (server uuids are always uuid4 strings).
+    def splice(self, head: str, uuid: str, tail: str) -> str: return head + uuid + tail
+
+    def uuid_fragment(self, uuid: str) -> str: return uuid
+
+    # Encoded list element, lists of them are joined by list_fragments.
+    def item(self, value) -> str: return json.dumps(value)
+
+    # Fragments of a shared packet whose first content field is a list of already encoded items.
+    def list_fragments(self, type: str, name: str, items: list, content: dict) -> tuple[str, str]:
+        return (
+            '{"type": ' + string(type) + ', "uuid": "',
+            '", ' + string(name) + ": [" + ", ".join(items) + "]" + (", " + json.dumps(content)[1:] if content else "}")
+        )
+
+class FastJSONCodec(JSONCodec):
+
+    name = "orjson"
+
+    # orjson refuses lone surrogates that json.loads lets through from clients, json escapes them.
+    @staticmethod
+    def dumps(value) -> bytes:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            return json.dumps(value, separators=(",", ":")).encode()
+
+    def encode(self, type: str, uuid: str, content: dict) -> str:
+        body = self.dumps(content)[1:-1]
+        return (b'{"type":' + self.dumps(type) + b',"uuid":' + self.dumps(uuid) + (b"," + body if body else b"") + b"}").decode()
+
+    def fragments(self, type: str, content: dict) -> tuple[str, str]:
+        body = self.dumps(content)[1:-1]
+        return (b'{"type":' + self.dumps(type) + b',"uuid":"').decode(), (b'"' + (b"," + body if body else b"") + b"}").decode()
+
+    # orjson's bytes keep their spare buffer space, decoded items are several times smaller to keep.
+    def item(self, value) -> str: return self.dumps(value).decode()
+
+    def list_fragments(self, type: str, name: str, items: list, content: dict) -> tuple[str, str]:
+        body = self.dumps(content)[1:-1]
+        return (
+            (b'{"type":' + self.dumps(type) + b',"uuid":"').decode(),
+            '",' + self.dumps(name).decode() + ":[" + ",".join(items) + "]" + ("," + body.decode() if body else "") + "}"
+        )
+
+# MessagePack map, sent as binary frames.
+class MsgpackCodec:
+
+    name = "msgpack"
+    binary = True
+
+    @staticmethod
+    def map_header(size: int) -> bytes:
+        if size < 16:
+            return bytes((0x80 | size,))
+        if size < 0x10000:
+            return b"\xde" + size.to_bytes(2, "big")
+        return b"\xdf" + size.to_bytes(4, "big")
+
+    @staticmethod
+    def array_header(size: int) -> bytes:
+        if size < 16:
+            return bytes((0x90 | size,))
+        if size < 0x10000:
+            return b"\xdc" + size.to_bytes(2, "big")
+        return b"\xdd" + size.to_bytes(4, "big")
+
+    # Strings msgpack can't store as UTF-8 (lone surrogates json.loads let through) get replacement characters.
+    @staticmethod
+    def pack(value) -> bytes: return msgpack.packb(value, unicode_errors="replace")
+
+    # Content is packed as a map in one call, its own map header is cut off.
+    def pairs(self, content: dict) -> bytes:
+        return self.pack(content)[len(self.map_header(len(content))):]
+
+    def encode(self, type: str, uuid: str, content: dict) -> bytes:
+        return self.map_header(len(content) + 2) + b"\xa4type" + self.pack(type) + b"\xa4uuid" + self.pack(uuid) + self.pairs(content)
+
+    def fragments(self, type: str, content: dict) -> tuple[bytes, bytes]:
+        return self.map_header(len(content) + 2) + b"\xa4type" + self.pack(type) + b"\xa4uuid", self.pairs(content)
+
+    def splice(self, head: bytes, uuid: str, tail: bytes) -> bytes: return head + self.pack(uuid) + tail
+
+    def uuid_fragment(self, uuid: str) -> bytes: return self.pack(uuid)
+
+    def item(self, value) -> bytes: return self.pack(value)
+
+    def list_fragments(self, type: str, name: str, items: list, content: dict) -> tuple[bytes, bytes]:
+        return (
+            self.map_header(len(content) + 3) + b"\xa4type" + self.pack(type) + b"\xa4uuid",
+            self.pack(name) + self.array_header(len(items)) + b"".join(items) + self.pairs(content)
+        )
+
+JSON = JSONCodec()
+CODECS = {"json": JSON}
+if FAST_JSON:
+    CODECS["orjson"] = FastJSONCodec()
+if MSGPACK:
+    CODECS["msgpack"] = MsgpackCodec()
+
+# First codec from client's list (its preference order) that is installed and allowed by the server.
+def negotiate(requested, allowed: list[str]):
+    if isinstance(requested, list):
+        for name in requested:
+            if name in allowed and name in CODECS:
+                return CODECS[name]
+    return JSON
+
+# Text frames are always JSON, binary frames are MessagePack or compressed JSON/MessagePack,
+# whatever codec was negotiated.
+def decode_frame(text: str | None, data: bytes | None) -> dict:
+    if text is None and data[:1] == COMPRESSED:
+        data = inflate(data[1:])
+        if data[:1] == b"{":
+            text = data
+    if text is not None:
+        if FAST_JSON:
+            try:
+                return orjson.loads(text)
+            except orjson.JSONDecodeError:
+                # orjson is stricter (e.g. lone surrogates), let json decide.
+                pass
+        return json.loads(text)
+    if not MSGPACK:
+        raise ValueError("binary frames need msgpack installed")
+    return msgpack.unpackb(data)
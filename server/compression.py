@@ -0,0 +1,42 @@
+import zlib
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+
+# Binary frames starting with this byte carry a raw deflate stream of an encoded frame
+# (JSON text as UTF-8 or MessagePack). It is never the first byte of a MessagePack packet.
+COMPRESSED = b"\x00"
+# Same as uvicorn ws_max_size, compressed frames can't inflate to more than that.
+INFLATE_LIMIT = 16 * 1024 * 1024
+
+# Raw deflate. Non-final parts end with a full flush: they are byte aligned and don't reference
+# each other, so separately compressed parts concatenate into one valid stream.
+def deflate(data: bytes, level: int = 6, final: bool = True) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_FULL_FLUSH)
+
+def compress(frame: str | bytes, level: int = 6) -> bytes:
+    return COMPRESSED + deflate(frame.encode() if isinstance(frame, str) else frame, level)
+
+def inflate(data: bytes, limit: int = INFLATE_LIMIT) -> bytes:
+    decompressor = zlib.decompressobj(-15)
+    result = decompressor.decompress(data, limit)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"compressed frame inflates to more than {limit} bytes")
+    return result
+
+# uvicorn websocket protocol with tunable permessage-deflate, uvicorn itself only allows to turn it on or off.
+# Options are ServerPerMessageDeflateFactory arguments, set once by the server on import.
+# close_timeout replaces websockets' 10 seconds wait for the closing handshake, a connection failed
+# by keepalive ping timeout is only released to the app after it.
+class DeflateWebSocketProtocol(WebSocketProtocol):
+
+    options: dict = {}
+    close_timeout: float | None = None
+
+    def __init__(self, *args, **kwargs):
+        close_timeout = self.close_timeout
+        super().__init__(*args, **kwargs)
+        if close_timeout is not None:
+            self.close_timeout = close_timeout
+        if self.config.ws_per_message_deflate:
+            self.available_extensions = [ServerPerMessageDeflateFactory(**self.options)]
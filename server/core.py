@@ -1,20 +1,407 @@
-
-import json
+import asyncio
+import secrets
+import time
+from bisect import bisect_left
+from collections import deque
+from itertools import islice
+from typing import Iterator, Literal
 from fastapi import WebSocket
+from codec import JSON, decode_frame
+from compression import COMPRESSED, compress, deflate
+
+QueuePolicy = Literal["drop-oldest", "coalesce", "disconnect"]
+ClientState = Literal["connecting", "connected", "parked", "gone"]
 
 class ClientData:
 
+    __slots__ = (
+        "ws", "server_uuid", "client_uuid", "nickname", "state",
+        "outbox", "outbox_size", "outbox_policy", "outbox_ready", "writer", "dropped", "resync", "closing", "close_reason", "rooms", "batch", "codec", "compress", "limiter",
+        "token", "parked_rooms", "parked_until", "last_write"
+    )
+
     def __init__(
             self,
             websocket: WebSocket,
             uuid: str,
             server_uuid: str,
-            nickname: str | None = None
+            nickname: str | None = None,
+            queue_size: int = 256,
+            queue_policy: QueuePolicy = "drop-oldest"
     ):
         self.ws = websocket
         self.server_uuid = server_uuid
         self.client_uuid = uuid
         self.nickname = nickname
+        self.state: ClientState = "connecting"
+
+        # Outbound frames are drained by a dedicated writer task, so a slow client
+        # only fills its own queue instead of stalling the sender and other clients.
+        # Every entry is (frame, covered), covered frames carry only history messages a resync resends.
+        self.outbox: deque[tuple[str | bytes | None, bool]] = deque()
+        self.outbox_size = queue_size
+        self.outbox_policy = queue_policy
+        self.outbox_ready = asyncio.Event()
+        self.writer: asyncio.Task | None = None
+        self.dropped = 0
+        self.resync = False
+        self.closing = False
+        self.close_reason: str | None = None
+        self.rooms: set[str] = set()
+        self.batch = False
+        self.codec = JSON
+        # (threshold, level) if the client accepts compressed frames
+        self.compress: tuple[int, int] | None = None
+        self.limiter: RateLimiter | None = None
+        # Resume token, set if the client asked for resumable session.
+        self.token: str | None = None
+        self.parked_rooms: tuple[str, ...] = ()
+        self.parked_until = 0.0
+        # Last writer progress (or first frame queued to an idle writer), the reaper
+        # drops clients that have queued frames and no progress for too long.
+        self.last_write = 0.0
+
+    @property
+    def queued(self): return len(self.outbox)
+
+    # Returns False when the frame can't be queued, the client is then being disconnected.
+    # Packets are encoded with the codec negotiated by the client.
+    def send(self, frame: "str | bytes | Packet", covered: bool = False) -> bool:
+        if self.closing:
+            return False
+        if isinstance(frame, Packet):
+            frame = frame.encode(self.codec)
+            if self.compress is not None and len(frame) >= self.compress[0]:
+                frame = compress(frame, self.compress[1])
+        if self.resync and covered:
+            # Resync history is sent at write time and already covers this frame.
+            self.dropped += 1
+            return True
+
+        if len(self.outbox) >= self.outbox_size:
+            if self.outbox_policy == "drop-oldest":
+                self.outbox.popleft()
+                self.dropped += 1
+            elif self.outbox_policy == "coalesce" and (covered or any(x[1] for x in self.outbox)):
+                # Pending history frames are replaced by a single resync of the client's histories,
+                # private messages, notices and acks stay queued.
+                kept = deque(x for x in self.outbox if not x[1])
+                self.dropped += len(self.outbox) - len(kept)
+                self.outbox = kept
+                self.resync = True
+                self.outbox_ready.set()
+                if covered:
+                    self.dropped += 1
+                    return True
+            else:
+                # Nothing to coalesce or drop, the writer closes the connection right away.
+                self.dropped += len(self.outbox) + 1
+                self.outbox.clear()
+                self.close("send queue overflow")
+                return False
+
+        if not self.outbox:
+            self.last_write = time.monotonic()
+        self.outbox.append((frame, covered))
+        self.outbox_ready.set()
+        return True
+
+    # Writer closes the websocket after sending everything queued before this call.
+    def close(self, reason: str | None = None):
+        if not self.closing:
+            self.closing = True
+            self.close_reason = reason
+            self.outbox.append((None, False))
+            self.outbox_ready.set()
+
+class TokenBucket:
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+# Token buckets per packet type, limits are packet type -> (packets per second, burst).
+# Types without their own limit share the "*" bucket. Buckets are created on first use.
+class RateLimiter:
+
+    __slots__ = ("limits", "buckets", "limited", "strikes", "last_strike")
+
+    def __init__(self, limits: dict[str, tuple[float, int]]):
+        self.limits = limits
+        self.buckets: dict[str, TokenBucket] = {}
+        self.limited = 0
+        self.strikes = 0
+        self.last_strike = 0.0
+
+    def allow(self, ptype: str, now: float) -> bool:
+        key = ptype if ptype in self.limits else "*"
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            limit = self.limits.get(key)
+            if limit is None:
+                return True
+            bucket = self.buckets[key] = TokenBucket(limit[0], limit[1], now)
+        if bucket.take(now):
+            return True
+        self.limited += 1
+        return False
+
+    # Strikes are forgotten after window seconds without violations. Returns current count.
+    def strike(self, now: float, window: float) -> int:
+        if now - self.last_strike > window:
+            self.strikes = 0
+        self.strikes += 1
+        self.last_strike = now
+        return self.strikes
+
+# Clients indexed by websocket, client uuid and nickname. State moves (connecting -> connected -> gone)
+# update every index at once, so lookups never see a half-registered client.
+# Clients with a resume token are parked instead of gone when the socket is lost: the nickname stays
+# reserved and a new connection can take the session over by its token.
+class ClientRegistry:
+
+    def __init__(self):
+        self.connecting: set[ClientData] = set()
+        self.connected: set[ClientData] = set()
+        self.by_ws: dict[WebSocket, ClientData] = {}
+        self.by_uuid: dict[str, ClientData] = {}
+        self.by_nickname: dict[str, ClientData] = {}
+        self.sessions: dict[str, ClientData] = {}
+
+    def __len__(self): return len(self.connected)
+
+    def __iter__(self): return iter(tuple(self.connected))
+
+    def __contains__(self, client: ClientData): return client in self.connected
+
+    def add(self, client: ClientData):
+        client.state = "connecting"
+        self.connecting.add(client)
+        self.by_ws[client.ws] = client
+
+    # Returns False if nickname is already taken by a connected client.
+    def accept(self, client: ClientData, nickname: str) -> bool:
+        if nickname in self.by_nickname:
+            return False
+
+        self.connecting.discard(client)
+        client.nickname = nickname
+        client.state = "connected"
+        self.connected.add(client)
+        self.by_ws[client.ws] = client
+        self.by_uuid[client.client_uuid] = client
+        self.by_nickname[nickname] = client
+        return True
+
+    def rename(self, client: ClientData, nickname: str) -> bool:
+        if nickname in self.by_nickname:
+            return False
+
+        if self.by_nickname.get(client.nickname) is client:
+            del self.by_nickname[client.nickname]
+        client.nickname = nickname
+        self.by_nickname[nickname] = client
+        return True
+
+    def remove(self, client: ClientData):
+        client.state = "gone"
+        self.connecting.discard(client)
+        self.connected.discard(client)
+        for index, key in ((self.by_ws, client.ws), (self.by_uuid, client.client_uuid), (self.by_nickname, client.nickname), (self.sessions, client.token)):
+            if index.get(key) is client:
+                del index[key]
+
+    def session(self, token) -> ClientData | None:
+        return self.sessions.get(token) if isinstance(token, str) else None
+
+    def issue(self, client: ClientData, token: str):
+        client.token = token
+        self.sessions[token] = client
+
+    # Returns False if the nickname was taken since the client was removed.
+    def park(self, client: ClientData) -> bool:
+        self.remove(client)
+        if client.nickname in self.by_nickname:
+            return False
+        client.state = "parked"
+        self.by_nickname[client.nickname] = client
+        self.sessions[client.token] = client
+        return True
+
+    # New connection takes over the session of a parked or still connected (ghost) client.
+    def resume(self, session: ClientData, client: ClientData):
+        self.remove(session)
+        self.connecting.discard(client)
+        client.nickname = session.nickname
+        client.state = "connected"
+        self.connected.add(client)
+        self.by_ws[client.ws] = client
+        self.by_uuid[client.client_uuid] = client
+        self.by_nickname[client.nickname] = client
+        self.issue(client, session.token)
+        session.token = None
+
+    def get_ws(self, ws: WebSocket) -> ClientData | None: return self.by_ws.get(ws)
+
+    def get_uuid(self, uuid: str) -> ClientData | None: return self.by_uuid.get(uuid)
+
+    def get_nickname(self, nickname: str) -> ClientData | None: return self.by_nickname.get(nickname)
+
+# Bounded chat history. Every stored message gets a server-assigned monotonic "seq",
+# which clients use as a cursor to fetch only what they missed.
+class MessageHistory:
+
+    def __init__(self, size: int):
+        self.messages: deque[dict] = deque(maxlen=size)
+        self.seq = 0
+        # Changes whenever seq starts over, so clients don't take old cursors for positions in this history.
+        self.epoch = secrets.token_hex(8)
+        # codec name -> (codec, encoded messages), kept in step with messages once a codec asked for them.
+        self.segments: dict[str, tuple] = {}
+        # Whole history packet, shared by all requesters until the next message.
+        self.cached: HistoryPacket | None = None
+
+    def __len__(self): return len(self.messages)
+
+    def __iter__(self): return iter(self.messages)
+
+    @property
+    def first(self): return self.messages[0]["seq"] if self.messages else self.seq + 1
+
+    def append(self, text: str, author: str, id: int) -> dict:
+        return self.add(self.next(text, author, id))
+
+    # Message that append would add, for callers that have to store it somewhere else first.
+    def next(self, text: str, author: str, id: int) -> dict:
+        return {"text": text, "author": author, "id": id, "seq": self.seq + 1}
+
+    def add(self, message: dict) -> dict:
+        self.seq = message["seq"]
+        self.messages.append(message)
+        self.cached = None
+        for codec, segments in self.segments.values():
+            segments.append(codec.item(message))
+        return message
+
+    # Refills history from stored messages (oldest first), keeping their seq.
+    def restore(self, stored: list[dict]):
+        self.messages.extend(stored)
+        if stored:
+            self.seq = max(self.seq, stored[-1]["seq"])
+            self.cached = None
+            for codec, segments in self.segments.values():
+                segments.extend(codec.item(x) for x in stored)
+
+    def encoded(self, codec) -> deque:
+        entry = self.segments.get(codec.name)
+        if entry is None:
+            entry = self.segments[codec.name] = (codec, deque((codec.item(x) for x in self.messages), maxlen=self.messages.maxlen))
+        return entry[1]
+
+    def snapshot(self, **content) -> "HistoryPacket":
+        if self.cached is None or self.cached.content != content:
+            self.cached = HistoryPacket(self, **content)
+        return self.cached
+
+    def page(self, start: int, stop: int | None = None, **content) -> "HistoryPacket":
+        return HistoryPacket(self, start, stop, **content)
+
+    # Position of the first message with seq greater than cursor.
+    def index(self, cursor: int) -> int: return max(0, cursor + 1 - self.first)
+
+    def last(self, count: int) -> list[dict]:
+        return list(islice(self.messages, max(0, len(self.messages) - count), None))
+
+    # Messages with seq greater than cursor, oldest first.
+    def after(self, cursor: int, limit: int | None = None) -> Iterator[dict]:
+        start = self.index(cursor)
+        return islice(self.messages, start, None if limit is None else start + limit)
+
+    def has_after(self, cursor: int): return cursor < self.seq and len(self.messages) > 0
+
+class Room:
+
+    __slots__ = ("name", "history", "members")
+
+    def __init__(self, name: str, history_size: int):
+        self.name = name
+        self.history = MessageHistory(history_size)
+        self.members: set[ClientData] = set()
+
+# Rooms exist while somebody is in them. Every room has its own history and member index,
+# so a room message is sent only to its members.
+class RoomRegistry:
+
+    def __init__(self, history_size: int):
+        self.history_size = history_size
+        self.rooms: dict[str, Room] = {}
+
+    def __len__(self): return len(self.rooms)
+
+    def get(self, name: str) -> Room | None: return self.rooms.get(name)
+
+    def create(self, name: str) -> Room:
+        room = self.rooms[name] = Room(name, self.history_size)
+        return room
+
+    def join(self, client: ClientData, room: Room):
+        room.members.add(client)
+        client.rooms.add(room.name)
+
+    # Returns True if the room became empty and was removed.
+    def leave(self, client: ClientData, name: str) -> bool:
+        client.rooms.discard(name)
+        room = self.rooms.get(name)
+        if room is None:
+            return False
+        room.members.discard(client)
+        if not room.members:
+            del self.rooms[name]
+            return True
+        return False
+
+# Latency histogram with fixed bucket upper bounds (seconds), same layout as Prometheus histograms.
+class Histogram:
+
+    def __init__(self, bounds: tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Cumulative counts per upper bound, last one is +Inf.
+    def cumulative(self) -> list[int]:
+        result = []
+        total = 0
+        for x in self.counts:
+            total += x
+            result.append(total)
+        return result
+
+    @property
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip([str(x) for x in self.bounds] + ["+Inf"], self.cumulative()))
+        }
 
 class Packet:
     
@@ -38,7 +425,77 @@ class Packet:
     def wsJSON(self): return {"type": self.type, "uuid": self.uuid, **self.content}
 
     @property
-    def wsPacket(self): return json.dumps({"type": self.type, "uuid": self.uuid, **self.content})
+    def wsPacket(self): return JSON.encode(self.type, self.uuid, self.content)
+
+    def encode(self, codec=JSON) -> str | bytes: return codec.encode(self.type, self.uuid, self.content)
+
+    # Packet from a text (JSON) or binary (MessagePack) frame, type and uuid are None if missing.
+    @staticmethod
+    def decode(text: str | None = None, data: bytes | None = None) -> "Packet":
+        content = decode_frame(text, data)
+        return Packet(content.pop("type", None), content.pop("uuid", None), **content)
+
+# Packet encoded once per codec and sent to many clients. Only the uuid differs between recipients,
+# so it is spliced between two pre-encoded fragments. JSON output is identical to Packet.wsPacket.
+class SharedPacket:
+
+    def __init__(
+            self,
+            type: str,
+            **content
+    ):
+        self.type = type
+        self.content = content
+
+        # Head and tail fragments by codec name, encoded on first use.
+        self.encoded: dict[str, tuple] = {}
+        self.compressed: dict[tuple[str, int], tuple[bytes, bytes]] = {}
+
+    def build(self, codec) -> tuple: return codec.fragments(self.type, self.content)
+
+    def fragments(self, codec) -> tuple:
+        fragments = self.encoded.get(codec.name)
+        if fragments is None:
+            fragments = self.encoded[codec.name] = self.build(codec)
+        return fragments
+
+    def wsPacketFor(self, uuid: str):
+        head, tail = self.fragments(JSON)
+        return head + uuid + tail
+
+    # Compressed frames are spliced too: head and tail are deflated once, only the uuid part
+    # is deflated for every recipient.
+    def frameFor(self, client: ClientData) -> str | bytes:
+        codec = client.codec
+        fragments = self.fragments(codec)
+
+        if client.compress is None or len(fragments[0]) + len(fragments[1]) < client.compress[0]:
+            return codec.splice(fragments[0], client.server_uuid, fragments[1])
+
+        key = (codec.name, client.compress[1])
+        compressed = self.compressed.get(key)
+        if compressed is None:
+            head, tail = (x.encode() if isinstance(x, str) else x for x in fragments)
+            compressed = self.compressed[key] = (
+                COMPRESSED + deflate(head, key[1], False),
+                deflate(tail, key[1])
+            )
+        uuid = codec.uuid_fragment(client.server_uuid)
+        return compressed[0] + deflate(uuid.encode() if isinstance(uuid, str) else uuid, key[1], False) + compressed[1]
+
+# "history" packet with messages [start, stop) of a history, joined from messages the history
+# keeps encoded for every codec in use, so a message is encoded once and not on every request.
+class HistoryPacket(SharedPacket):
+
+    def __init__(self, history: "MessageHistory", start: int = 0, stop: int | None = None, **content):
+        super().__init__("history", **content)
+        self.history = history
+        self.start = start
+        self.stop = stop
+
+    def build(self, codec) -> tuple:
+        items = list(islice(self.history.encoded(codec), self.start, self.stop))
+        return codec.list_fragments(self.type, "messages", items, self.content)
 
 class ConnectionMeta(Packet):
 
@@ -47,8 +504,8 @@ class ConnectionMeta(Packet):
 
 class ConnectionAccept(Packet):
 
-    def __init__(self, uuid: str):
-        super().__init__("connaccept", uuid)
+    def __init__(self, uuid: str, **options):
+        super().__init__("connaccept", uuid, **options)
 
 class ConnectionReject(Packet):
 
@@ -70,15 +527,32 @@ class DisconnectionAgree(Packet):
     def __init__(self, uuid: str):
         super().__init__("dcon-agree", uuid)
 
+# Without limit "from" is the amount of last messages (legacy clients),
+# with limit it is a seq cursor and history is sent in pages.
 class GetHistory(Packet):
 
-    def __init__(self, uuid: str, lastmsg: int = 512):
-        super().__init__("getHistory", uuid, **{"from": lastmsg})
+    def __init__(self, uuid: str, lastmsg: int = 512, limit: int | None = None):
+        super().__init__("getHistory", uuid, **{"from": lastmsg} | ({} if limit is None else {"limit": limit}))
 
 class History(Packet):
 
-    def __init__(self, uuid: str, messages: list):
-        super().__init__("history", uuid, **{"messages": messages})
+    def __init__(self, uuid: str, messages: list, **page):
+        super().__init__("history", uuid, **{"messages": messages}, **page)
+
+class JoinRoom(Packet):
+
+    def __init__(self, uuid: str, room: str):
+        super().__init__("joinRoom", uuid, **{"room": room})
+
+class LeaveRoom(Packet):
+
+    def __init__(self, uuid: str, room: str):
+        super().__init__("leaveRoom", uuid, **{"room": room})
+
+class Messages(Packet):
+
+    def __init__(self, uuid: str, messages: list, **room):
+        super().__init__("messages", uuid, **{"messages": messages}, **room)
 
 class Message(Packet):
 
@@ -0,0 +1,297 @@
+import asyncio
+import binascii
+import hashlib
+import importlib.util
+import os
+import re
+import string
+import uuid
+from collections import OrderedDict
+from typing import Callable
+from aiofiles import open as asyncopen
+
+# The legacy parser uses BeautifulSoup with the lxml backend.
+try:
+    from bs4 import BeautifulSoup
+    LEGACY_PARSER = importlib.util.find_spec("lxml") is not None
+except ImportError:
+    LEGACY_PARSER = False
+
+CHUNK_SIZE = 64 * 1024
+BASE64_CHUNK_SIZE = 256 * 1024
+
+# src attribute of img/video/audio tag holding a base64 data URI, match ends right before the payload.
+DATA_URI = re.compile(r"""<(?:img|video|audio)\b[^>]*?\bsrc\s*=\s*(["']?)data:([^;,"'\s>]*)(?:;[^;,"'\s>]*)*?;base64,""", re.IGNORECASE)
+UNQUOTED_END = re.compile(r"[\s>]")
+
+# Decodes a base64 part of text chunk by chunk, so the whole decoded file is never in memory at once.
+class Base64Reader:
+
+    def __init__(self, text: str, start: int, end: int):
+        self.text = text
+        self.pos = start
+        self.end = end
+
+    async def read(self, size: int = -1) -> bytes:
+        if self.pos >= self.end:
+            return b""
+        chunk = self.text[self.pos:min(self.pos + BASE64_CHUNK_SIZE, self.end)]
+        self.pos += len(chunk)
+        return binascii.a2b_base64(chunk)
+
+# Content-addressed media files with byte and entry budgets. Least recently used files
+# are evicted from disk, small hot files are additionally kept in memory.
+class MediaCache:
+
+    def __init__(
+            self,
+            directory: str,
+            max_bytes: int = 1024 * 1024 * 1024,
+            max_entries: int = 10000,
+            memory_bytes: int = 64 * 1024 * 1024,
+            memory_file_size: int = 1024 * 1024
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.memory_bytes = memory_bytes
+        self.memory_file_size = memory_file_size
+
+        # file id -> size, least recently used first
+        self.index: OrderedDict[str, int] = OrderedDict()
+        self.types: dict[str, str] = {}
+        self.size = 0
+        self.memory: OrderedDict[str, bytes] = OrderedDict()
+        self.memory_size = 0
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Uploaded (and extracted from base64) files accepted by store().
+        self.stored = 0
+        self.stored_bytes = 0
+
+        # file id -> [event, waiters count], files that somebody requested before they were written
+        self.pending: dict[str, list] = {}
+        self.loop: asyncio.AbstractEventLoop | None = None
+        # Called for files stored by this process, lets other server shards index them.
+        self.on_store: Callable[[str, str | None], None] | None = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.scan()
+
+    # Indexes files left from previous runs, oldest modification first.
+    def scan(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(".upload-"):
+                os.remove(entry.path)
+            elif entry.is_file() and self.valid(entry.name):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, fileid, size in sorted(files):
+            self.index[fileid] = size
+            self.size += size
+        self.evict()
+
+    def evict(self, keep: str | None = None):
+        while self.index and (self.size > self.max_bytes or len(self.index) > self.max_entries):
+            fileid, size = self.index.popitem(last=False)
+            if fileid == keep:
+                self.index[fileid] = size
+                if len(self.index) == 1:
+                    break
+                continue
+            self.size -= size
+            self.evictions += 1
+            self.types.pop(fileid, None)
+            self.drop_memory(fileid)
+            try:
+                os.remove(self.path(fileid))
+            except OSError:
+                pass
+
+    def drop_memory(self, fileid: str):
+        data = self.memory.pop(fileid, None)
+        if data is not None:
+            self.memory_size -= len(data)
+
+    def add(self, fileid: str, size: int):
+        if fileid in self.index:
+            self.index.move_to_end(fileid)
+            return
+        self.index[fileid] = size
+        self.size += size
+        self.evict(keep=fileid)
+
+    @property
+    def stats(self):
+        return {
+            "entries": len(self.index),
+            "bytes": self.size,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_size,
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stored": self.stored,
+            "stored_bytes": self.stored_bytes
+        }
+
+    def touch(self, fileid: str):
+        if fileid in self.index:
+            self.index.move_to_end(fileid)
+            self.hits += 1
+
+    # Marks file as recently used. Returns its content if it is (or now gets) cached in memory,
+    # None if it should be served from disk.
+    async def get(self, fileid: str) -> bytes | None:
+        self.touch(fileid)
+
+        data = self.memory.get(fileid)
+        if data is not None:
+            self.memory.move_to_end(fileid)
+            self.memory_hits += 1
+            return data
+
+        size = self.index.get(fileid)
+        if size is None or size > self.memory_file_size or size > self.memory_bytes:
+            return None
+
+        try:
+            async with asyncopen(self.path(fileid), "rb") as f:
+                data = await f.read()
+        except OSError:
+            return None
+        if fileid not in self.index:
+            return data
+
+        self.drop_memory(fileid)
+        self.memory[fileid] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_bytes:
+            self.drop_memory(next(iter(self.memory)))
+        return data
+
+    @staticmethod
+    def valid(fileid: str):
+        return len(fileid) == 64 and all(x in string.hexdigits for x in fileid)
+
+    def path(self, fileid: str): return os.path.join(self.directory, fileid)
+
+    def exists(self, fileid: str): return fileid in self.index
+
+    # Content type is known only for files stored by this run, browsers sniff the rest.
+    def media_type(self, fileid: str): return self.types.get(fileid, "application/octet-stream")
+
+    # Called after the file is completely written, indexes it and wakes up everyone waiting for it.
+    # announce=False for files written by other shards into the shared directory.
+    def ready(self, fileid: str, media_type: str | None = None, announce: bool = True):
+        try:
+            self.add(fileid, os.path.getsize(self.path(fileid)))
+        except OSError:
+            return
+        if media_type is not None:
+            self.types[fileid] = media_type
+        waiting = self.pending.pop(fileid, None)
+        if waiting is not None:
+            waiting[0].set()
+        if announce and self.on_store is not None:
+            self.on_store(fileid, media_type)
+
+    def ready_threadsafe(self, fileid: str, media_type: str | None = None):
+        self.loop.call_soon_threadsafe(self.ready, fileid, media_type)
+
+    async def wait(self, fileid: str, timeout: float) -> bool:
+        if self.exists(fileid):
+            return True
+        self.misses += 1
+
+        waiting = self.pending.setdefault(fileid, [asyncio.Event(), 0])
+        waiting[1] += 1
+        try:
+            await asyncio.wait_for(waiting[0].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiting[1] -= 1
+            if waiting[1] == 0 and self.pending.get(fileid) is waiting:
+                del self.pending[fileid]
+
+    # Streams upload into a temp file while hashing it, then renames it to its sha256.
+    # Returns None if upload is bigger than limit. Already cached content is not stored twice.
+    async def store(self, file, limit: int, media_type: str | None = None) -> str | None:
+        temp = os.path.join(self.directory, f".upload-{uuid.uuid4().hex}")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async with asyncopen(temp, "wb") as f:
+                while chunk := await file.read(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > limit:
+                        return None
+                    digest.update(chunk)
+                    await f.write(chunk)
+
+            fileid = digest.hexdigest()
+            self.stored += 1
+            self.stored_bytes += size
+            if not self.exists(fileid):
+                os.replace(temp, self.path(fileid))
+            self.ready(fileid, media_type)
+            return fileid
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    # Replaces base64 data URIs in img/video/audio tags with links to cached files in one pass over text.
+    # Tags that can't be decoded or are bigger than limit are left as is.
+    async def extract(self, text: str, url: Callable[[str], str], limit: int) -> str:
+        parts = []
+        pos = 0
+        while match := DATA_URI.search(text, pos):
+            quote, media_type = match.group(1), match.group(2)
+            start = match.end()
+            if quote:
+                end = text.find(quote, start)
+            else:
+                found = UNQUOTED_END.search(text, start)
+                end = found.start() if found else -1
+            if end == -1:
+                end = len(text)
+
+            try:
+                fileid = await self.store(Base64Reader(text, start, end), limit, media_type or None)
+            except binascii.Error:
+                fileid = None
+
+            if fileid is None:
+                parts.append(text[pos:end])
+            else:
+                parts.append(text[pos:match.start(1) + len(quote)])
+                parts.append(url(fileid))
+            pos = end
+
+        if not parts:
+            return text
+        parts.append(text[pos:])
+        return "".join(parts)
+
+    # Previous BeautifulSoup based extractor, needs bs4 and lxml. Blocking, run it in a thread.
+    def extract_legacy(self, text: str, url: Callable[[str], str]) -> str:
+        bs4 = BeautifulSoup(text, "lxml")
+        for tag in bs4.find_all(["img", "video", "audio"]):
+            if tag.get("src", "").startswith("data:") and "base64" in tag["src"]:
+                rawbase64 = tag["src"].split(";")
+                rawdata = binascii.a2b_base64(rawbase64[-1].split(",")[-1])
+
+                fileid = hashlib.sha256(rawdata).hexdigest()
+                with open(self.path(fileid), "wb") as f:
+                    f.write(rawdata)
+                self.ready_threadsafe(fileid, rawbase64[0].removeprefix("data:"))
+                tag["src"] = url(fileid)
+        return str(bs4)
@@ -0,0 +1,57 @@
+from typing import Iterable
+from core import Histogram
+
+# Fan-out of one message to all recipient queues, from tens of microseconds to milliseconds.
+FANOUT_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+# Packet types handled by the server, anything else is counted as "other",
+# so clients can't create new series by sending made up types.
+PACKET_TYPES = ("connmeta", "getHistory", "message", "privateMessage", "nickchange", "disconnect", "joinRoom", "leaveRoom")
+
+# Hot path counters, everything else is read from server state at scrape time.
+class Metrics:
+
+    def __init__(self):
+        self.packets = dict.fromkeys(PACKET_TYPES + ("other",), 0)
+        self.fanout = {"immediate": Histogram(FANOUT_BOUNDS), "batch": Histogram(FANOUT_BOUNDS)}
+        self.frames = 0
+        self.dispatch: dict[str, Histogram] = {}
+        self.limited = 0
+
+    def packet(self, ptype: str):
+        if ptype in self.packets:
+            self.packets[ptype] += 1
+        else:
+            self.packets["other"] += 1
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def labels(values: dict | None) -> str:
+    if not values:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in values.items()) + "}"
+
+# Prometheus text exposition format 0.0.4.
+class Exposition:
+
+    def __init__(self):
+        self.lines: list[str] = []
+
+    def metric(self, name: str, kind: str, help: str, samples: Iterable[tuple[dict | None, float]]):
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for values, value in samples:
+            self.lines.append(f"{name}{labels(values)} {value}")
+
+    def histogram(self, name: str, help: str, series: Iterable[tuple[dict | None, Histogram]]):
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for values, histogram in series:
+            values = values or {}
+            for bound, count in zip([str(x) for x in histogram.bounds] + ["+Inf"], histogram.cumulative()):
+                self.lines.append(f"{name}_bucket{labels({**values, 'le': bound})} {count}")
+            self.lines.append(f"{name}_sum{labels(values)} {histogram.sum}")
+            self.lines.append(f"{name}_count{labels(values)} {histogram.count}")
+
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import os
+import secrets
+import struct
+import zlib
+
+# Record layout: [length u32][crc32 u32][payload][length u32].
+# Trailing length lets the log be read from the end without scanning whole segments.
+HEADER = struct.Struct("<II")
+TRAILER = struct.Struct("<I")
+OVERHEAD = HEADER.size + TRAILER.size
+# Tail of the last segment checked record by record on startup. A crash can damage only what
+# wasn't fsynced yet, the rest of the segment is not read.
+RECOVER_WINDOW = 1024 * 1024
+
+class MessageLog:
+
+    def __init__(
+            self,
+            directory: str,
+            segment_size: int = 16 * 1024 * 1024,
+            retention_segments: int = 8,
+            fsync_interval: float = 1.0
+    ):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_segments = max(1, retention_segments)
+        self.fsync_interval = fsync_interval
+
+        self.segments: list[str] = []
+        self.file = None
+        self.size = 0
+        self.pending = 0
+        self.flusher: asyncio.Task | None = None
+        self.epoch: str | None = None
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # History epoch lives as long as the log directory, seq continues across restarts.
+        path = os.path.join(self.directory, "epoch")
+        if os.path.exists(path):
+            with open(path, "rt") as f:
+                self.epoch = f.read().strip()
+        if not self.epoch:
+            self.epoch = secrets.token_hex(8)
+            with open(path, "wt") as f:
+                f.write(self.epoch)
+        self.segments = sorted(x for x in os.listdir(self.directory) if x.endswith(".log"))
+        if self.segments:
+            path = os.path.join(self.directory, self.segments[-1])
+            self.size = self.recover(path)
+            self.file = open(path, "ab", buffering=1024 * 1024)
+
+    # Cuts a torn record left by a crash at the end of the last segment. Only the end of the segment is read.
+    @staticmethod
+    def recover(path: str) -> int:
+        with open(path, "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            valid = MessageLog.last_record_end(f, size)
+            if valid != size:
+                f.truncate(valid)
+        return valid
+
+    # Start of the record ending at pos, None if no whole record ends there: its trailing length has to
+    # point back at a header with the same length and the crc has to match.
+    @staticmethod
+    def record_start(f, pos: int) -> int | None:
+        if pos < OVERHEAD:
+            return None
+        f.seek(pos - TRAILER.size)
+        length = TRAILER.unpack(f.read(TRAILER.size))[0]
+        start = pos - OVERHEAD - length
+        # Payload is never empty, zeros a crash left at the end would pass the crc check otherwise.
+        if length == 0 or start < 0:
+            return None
+        f.seek(start)
+        stored, crc = HEADER.unpack(f.read(HEADER.size))
+        if stored != length or zlib.crc32(f.read(length)) != crc:
+            return None
+        return start
+
+    # First position in the last RECOVER_WINDOW bytes before end where the chain of records is broken.
+    @staticmethod
+    def hole(f, end: int) -> int | None:
+        pos = end
+        while pos > max(0, end - RECOVER_WINDOW):
+            start = MessageLog.record_start(f, pos)
+            if start is None:
+                return pos
+            pos = start
+        return None
+
+    # End of the last whole record, records after a hole don't count. After a clean shutdown that is
+    # the end of file, the first position tried. Otherwise positions before it are tried one by one,
+    # the trailer and header lengths are compared on a window of the file before reading a record.
+    @staticmethod
+    def last_record_end(f, end: int) -> int:
+        while end >= OVERHEAD:
+            base = max(0, end - RECOVER_WINDOW)
+            f.seek(base)
+            data = f.read(end - base)
+            for pos in range(end, max(base + TRAILER.size, OVERHEAD) - 1, -1):
+                length = TRAILER.unpack_from(data, pos - base - TRAILER.size)[0]
+                start = pos - OVERHEAD - length
+                if length == 0 or start < 0 or (start >= base and HEADER.unpack_from(data, start - base)[0] != length):
+                    continue
+                if MessageLog.record_start(f, pos) is None:
+                    continue
+                hole = MessageLog.hole(f, pos)
+                if hole is None:
+                    return pos
+                end = hole - 1
+                break
+            else:
+                end = base + TRAILER.size - 1
+        return 0
+
+    def rotate(self, seq: int):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+        name = f"{seq:020d}.log"
+        self.segments.append(name)
+        self.file = open(os.path.join(self.directory, name), "ab", buffering=1024 * 1024)
+        self.size = 0
+        self.pending = 0
+
+        while len(self.segments) > self.retention_segments:
+            os.remove(os.path.join(self.directory, self.segments.pop(0)))
+
+    def append(self, message: dict):
+        if self.file is None or self.size >= self.segment_size:
+            self.rotate(message["seq"])
+
+        # surrogatepass keeps lone surrogates json.loads accepted from clients, json.loads reads them back.
+        payload = json.dumps(message, ensure_ascii=False).encode("utf-8", "surrogatepass")
+        self.file.write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload + TRAILER.pack(len(payload)))
+        self.size += len(payload) + OVERHEAD
+        self.pending += 1
+
+    def sync(self):
+        if self.file is not None and self.pending:
+            self.pending = 0
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            if self.file is not None and self.pending:
+                self.pending = 0
+                self.file.flush()
+                try:
+                    await asyncio.to_thread(os.fsync, self.file.fileno())
+                except OSError:
+                    # Segment was rotated meanwhile, rotate() syncs it itself.
+                    pass
+
+    def start(self):
+        self.flusher = asyncio.create_task(self.run_flusher())
+
+    def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    # Last count messages, oldest first. Segments are read backwards from the end.
+    def tail(self, count: int) -> list[dict]:
+        if self.file is not None:
+            self.file.flush()
+
+        result = []
+        for name in reversed(self.segments):
+            with open(os.path.join(self.directory, name), "rb") as f:
+                pos = f.seek(0, os.SEEK_END)
+                while pos >= OVERHEAD and len(result) < count:
+                    f.seek(pos - TRAILER.size)
+                    length = TRAILER.unpack(f.read(TRAILER.size))[0]
+                    start = pos - OVERHEAD - length
+                    if start < 0:
+                        break
+                    f.seek(start)
+                    record = f.read(OVERHEAD + length)
+                    stored, crc = HEADER.unpack_from(record)
+                    payload = record[HEADER.size:HEADER.size + length]
+                    if stored != length or zlib.crc32(payload) != crc:
+                        break
+                    result.append(json.loads(payload))
+                    pos = start
+            if len(result) >= count:
+                break
+
+        result.reverse()
+        return result
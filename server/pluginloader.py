@@ -0,0 +1,33 @@
+import importlib.util
+import logging
+import os
+import sys
+
+# Plugins loaded inside plugin process pool workers, (directory, plugin) -> plugin object.
+loaded: dict[tuple[str, str], object] = {}
+
+def load_plugin(directory: str, plugin: str, mainfile: str, entry: str):
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(
+            f"{plugin}.{entry.removesuffix('.py')}",
+            os.path.abspath(os.path.join(directory, plugin, mainfile))
+        )
+        module = importlib.util.module_from_spec(spec)
+        module.__package__ = plugin
+        spec.loader.exec_module(module)
+        return getattr(module, entry)
+    finally:
+        sys.path.remove(directory)
+
+# Runs in a process pool worker. Plugin is loaded once per worker (with its own globals),
+# results are converted to plain values since plugin classes can't be unpickled by the server.
+def run_hook(directory: str, plugin: str, mainfile: str, entry: str, plugin_id: str, index: int, config, *args):
+    key = (directory, plugin)
+    if key not in loaded:
+        loaded[key] = load_plugin(directory, plugin, mainfile, entry)
+
+    cb = loaded[key].events[index].callback(config, logging.getLogger(f"plugins::{plugin_id}"), *args)
+    if hasattr(cb, "type") and hasattr(cb, "content"):
+        return ("packet", cb.type, getattr(cb, "uuid", None), dict(cb.content))
+    return cb if cb == "drop" else bool(cb)
@@ -23,8 +23,8 @@ def startup(config: BaseModel, logger: Logger):
     cfg = pluginconfig
     return True
 
-@plugin.event("on_packet", "message")
-def onMessage(config: BaseModel, logger: Logger, clients: set[ClientData], messages: list, packet: Packet, ws: WebSocket):
+@plugin.event("on_packet", "message", timeout=0.5)
+async def onMessage(config: BaseModel, logger: Logger, clients: set[ClientData], messages: list, packet: Packet, ws: WebSocket):
     return True
 
 @plugin.event("on_shutdown", None)
@@ -1,9 +1,10 @@
 
-from typing import Callable, Literal
+from typing import Awaitable, Callable, Literal
 from pydantic import BaseModel
 from logging import Logger
 from fastapi.websockets import WebSocket
 
+import inspect
 import logging
 import json
 import os
@@ -121,6 +122,16 @@ class History(Packet):
     def __init__(self, uuid: str, messages: list):
         super().__init__("history", uuid, **{"messages": messages})
 
+class JoinRoom(Packet):
+
+    def __init__(self, uuid: str, room: str):
+        super().__init__("joinRoom", uuid, **{"room": room})
+
+class LeaveRoom(Packet):
+
+    def __init__(self, uuid: str, room: str):
+        super().__init__("leaveRoom", uuid, **{"room": room})
+
 class Message(Packet):
 
     def __init__(self, uuid: str, text: str, author: str, id: int):
@@ -131,17 +142,35 @@ class NicknameChange(Packet):
     def __init__(self, uuid: str, nickname: str):
         super().__init__("nickchange", uuid, **{"nickname": nickname})
 
+# on_packet callbacks may return DROP to stop processing of the packet, or a Packet
+# to replace it for next plugins and the server. Any other falsy result is logged as a warning.
+DROP = "drop"
+
+PacketResult = bool | Packet | Literal["drop"]
+
 class ServerEvent:
 
     def __init__(
             self,
-            callback: Callable[[BaseModel, Logger], bool] | Callable[[BaseModel, Logger, Packet, WebSocket, set[ClientData]], bool],
+            callback: Callable[[BaseModel, Logger], bool | Awaitable[bool]] | Callable[[BaseModel, Logger, set[ClientData], list, Packet, WebSocket], PacketResult | Awaitable[PacketResult]],
             event_type: Literal['on_startup', 'on_packet', 'on_shutdown'],
-            event_trigger: Literal['connmeta', 'connaccept', 'connreject', 'connclose', 'message', 'privateMessage', 'getHistory', 'history', 'nickchange'] | None = None
+            event_trigger: Literal['connmeta', 'connaccept', 'connreject', 'connclose', 'message', 'privateMessage', 'getHistory', 'history', 'nickchange', 'joinRoom', 'leaveRoom'] | None = None,
+            timeout: float | None = None,
+            executor: bool | Literal['thread', 'process'] = False
         ):
             self.callback = callback
             self.event_type = event_type
             self.event_trigger = event_trigger if event_type == "on_packet" else None
+            # async callbacks run on the server event loop, sync ones inline or,
+            # with executor=True (for blocking work), in a worker thread. executor="process" runs on_packet
+            # callbacks in the server plugin process pool (if enabled) for CPU-heavy work: the plugin module
+            # is loaded again in each worker, clients and ws are None there and history is a copy.
+            # Thread callbacks get copies of clients and history too, taken before the call.
+            # timeout overrides server plugin_timeout for async and executor callbacks, sync callbacks
+            # without executor run on the event loop and can't be interrupted, timeout has no effect there.
+            self.is_async = inspect.iscoroutinefunction(callback)
+            self.timeout = timeout
+            self.executor = executor and not self.is_async
     
     @property
     def etype(self): return self.event_type
@@ -153,20 +182,22 @@ class ServerPlugin:
 
     def __init__(
             self,
-            events: list[ServerEvent] = []
+            events: list[ServerEvent] | None = None
     ):
-        self.events = events
+        self.events = events if events is not None else []
     
     def add_event(self, event: ServerEvent):
         self.events.append(event)
     
-    def event(self, etype, etrigger):
+    def event(self, etype, etrigger, timeout: float | None = None, executor: bool | Literal['thread', 'process'] = False):
         def wrapper(func):
             self.events.append(
                 ServerEvent(
                     func,
                     etype,
-                    etrigger
+                    etrigger,
+                    timeout,
+                    executor
                 )
             )
             return func
@@ -1,11 +1,16 @@
 import asyncio
-import base64
-import hashlib
-import importlib.util
-from collections import deque
-from core import ConnectionClose, ConnectionReject, DisconnectionAgree, NicknameChange, Packet, Message, History, ConnectionAccept, ConnectionMeta, ClientData
+from concurrent.futures import ProcessPoolExecutor
+from typing import Literal
+from msglog import MessageLog
+from backplane import Broker, LocalBackplane, UnixBackplane
+from codec import CODECS, negotiate
+from compression import DeflateWebSocketProtocol
+from pluginloader import load_plugin, run_hook
+from mediacache import LEGACY_PARSER, MediaCache
+from metrics import Exposition, Metrics
+from core import ConnectionClose, ConnectionReject, DisconnectionAgree, NicknameChange, Packet, Message, ConnectionAccept, ConnectionMeta, ClientData, ClientRegistry, MessageHistory, SharedPacket, Histogram, JoinRoom, LeaveRoom, Room, RoomRegistry, RateLimiter
 
-import json, time, uuid, os, traceback, socket, logging, importlib, sys
+import json, time, uuid, os, traceback, socket, logging, inspect, secrets
 
 import logging
 from queue import SimpleQueue
@@ -13,10 +18,9 @@ from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 from aiofiles import open as asyncopen
 from pydantic import BaseModel
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, Form, File
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, UploadFile, Form, File
 from fastapi.websockets import WebSocketState
 from fastapi.responses import FileResponse, Response, PlainTextResponse
-from bs4 import BeautifulSoup
 os.chdir(os.path.dirname(__file__))
 __version__ = "0.1.82"
 
@@ -24,9 +28,12 @@ class ServerConfig(BaseModel):
     ip: str = "0.0.0.0"
     port: int = 5656
     server_size: int = 256
+    handshake_timeout: float = 10.0
+    handshake_max_pending: int = 64
     server_nickname: str = "server"
     server_message_size: int = 8192
     server_history_size: int = 1024
+    history_chunk_size: int = 128
     server_path: str = "/"
     certs: tuple | None = None
     allow_client_version: str = __version__
@@ -34,6 +41,68 @@ class ServerConfig(BaseModel):
     plugins_directory: str = os.path.abspath(os.path.join(os.path.dirname(__file__), "plugins"))
     errorlog_directory: str = os.path.abspath(os.path.join(os.path.dirname(__file__), "errors"))
     cache_directory: str = os.path.abspath(os.path.join(os.path.dirname(__file__), "cache"))
+    cache_wait_timeout: float = 30.0
+    cache_max_bytes: int = 1024 * 1024 * 1024
+    cache_max_entries: int = 10000
+    cache_memory_bytes: int = 64 * 1024 * 1024
+    cache_memory_file_size: int = 1024 * 1024
+    upload_max_size: int = 64 * 1024 * 1024
+    legacy_media_parser: bool = False
+    plugin_timeout: float = 1.0
+    plugin_budget: float = 0.05
+    plugin_max_overruns: int = 5
+    plugin_cooldown: float = 60.0
+    plugin_process_pool: int = 0
+    message_log: bool = False
+    message_log_directory: str = os.path.abspath(os.path.join(os.path.dirname(__file__), "log"))
+    message_log_segment_size: int = 16 * 1024 * 1024
+    # Oldest whole segments are deleted past this count. That is all the compaction there is: chat
+    # records are never updated or deleted, so there is nothing to drop from inside a segment.
+    message_log_retention_segments: int = 8
+    message_log_fsync_interval: float = 1.0
+    client_queue_size: int = 256
+    client_queue_policy: Literal["drop-oldest", "coalesce", "disconnect"] = "drop-oldest"
+    codecs: list[str] = ["msgpack", "orjson", "json"]
+    ws_deflate: bool = True
+    ws_deflate_level: int = 6
+    ws_deflate_mem_level: int = 8
+    ws_deflate_window_bits: int = 15
+    ws_deflate_context_takeover: bool = True
+    compression_threshold: int = 1024
+    compression_level: int = 6
+    batch_interval: float = 0.05
+    batch_size: int = 64
+    rooms_max: int = 64
+    room_max_size: int = 256
+    room_history_size: int = 256
+    room_name_size: int = 64
+    client_max_rooms: int = 8
+    # Packet type -> (packets per second, burst), "*" is for every type without its own limit.
+    rate_limits: dict[str, tuple[float, int]] = {
+        "*": (20.0, 40),
+        "message": (3.0, 10),
+        "privateMessage": (2.0, 6),
+        "getHistory": (0.5, 4),
+        "nickchange": (0.1, 2),
+        "joinRoom": (1.0, 8)
+    }
+    # Same, shared by all connections from one IP.
+    rate_limits_ip: dict[str, tuple[float, int]] = {
+        "*": (60.0, 120),
+        "message": (10.0, 30),
+        "privateMessage": (6.0, 18),
+        "getHistory": (2.0, 12),
+        "nickchange": (0.3, 6),
+        "joinRoom": (3.0, 24)
+    }
+    rate_limit_strikes: int = 5
+    resume_grace: float = 30.0
+    heartbeat_interval: float = 20.0
+    heartbeat_timeout: float = 20.0
+    reaper_interval: float = 5.0
+    rate_limit_strike_window: float = 30.0
+    workers: int = 1
+    backplane_socket: str = os.path.abspath(os.path.join(os.path.dirname(__file__), "muco-backplane.sock"))
     log_level: int = logging.INFO
 
     @staticmethod
@@ -56,10 +125,45 @@ class ServerConfig(BaseModel):
             f.write(json.dumps(self.model_dump(), indent=4))
 
 config = ServerConfig.load()
-messages: deque[dict] = deque(maxlen=config.server_history_size)
-connecting: set[ClientData] = set()
-clients: set[ClientData] = set()
+messages = MessageHistory(config.server_history_size)
+clients = ClientRegistry()
+rooms = RoomRegistry(config.room_history_size)
+media = MediaCache(
+    config.cache_directory,
+    config.cache_max_bytes,
+    config.cache_max_entries,
+    config.cache_memory_bytes,
+    config.cache_memory_file_size
+)
+msglog = MessageLog(
+    config.message_log_directory,
+    config.message_log_segment_size,
+    config.message_log_retention_segments,
+    config.message_log_fsync_interval
+) if config.message_log else None
 plugins = []
+events: dict[tuple[str, str | None], list[tuple[dict, object, int, str, float]]] = {}
+plugin_pool: ProcessPoolExecutor | None = None
+# room (None for the main chat) -> messages waiting for the next "messages" batch
+batches: dict[str | None, list[dict]] = {}
+batch_timer: asyncio.TimerHandle | None = None
+# Connections accepted by admission control that haven't finished the handshake yet.
+handshakes = 0
+# Admission limits are checked by every shard on its own, each shard gets an equal share of them
+# so all workers together stay within server_size. With uneven load a shard can be full while others aren't.
+shard_size = max(1, config.server_size // config.workers)
+shard_max_pending = max(1, config.handshake_max_pending // config.workers)
+# Sessions live in a worker, so resume is only possible with a single worker.
+resumable = config.resume_grace > 0 and config.workers == 1
+reaper_task: asyncio.Task | None = None
+# Connections dropped by the reaper, by reason.
+reaped = {"closed": 0, "stalled": 0, "expired": 0}
+# IP -> [connections, limiter], removed with the last connection.
+ip_limiters: dict[str, list] = {}
+# packet type -> [dispatches, total seconds, max seconds]
+dispatch_stats: dict[str, list] = {}
+metrics = Metrics()
+serverip = socket.gethostbyname(socket.gethostname())
 if config.allow_server_actual_version:
     config.allow_client_version = __version__
 
@@ -80,49 +184,190 @@ pluginslogger = logging.getLogger("plugins")
 shutdownlogger = logging.getLogger("shutdown")
 wslogger = logging.getLogger("ws")
 cachelogger = logging.getLogger("cache")
+backplanelogger = logging.getLogger("backplane")
 
-for x in (initlogger, pluginslogger, shutdownlogger, wslogger, cachelogger):
+for x in (initlogger, pluginslogger, shutdownlogger, wslogger, cachelogger, backplanelogger):
     x.setLevel(config.log_level)
-    x.addHandler(queue_handler)
+    # Worker processes (workers > 1) import this module twice, as __mp_main__ and as server.
+    if not x.handlers:
+        x.addHandler(queue_handler)
+
+DeflateWebSocketProtocol.options = {
+    "server_no_context_takeover": not config.ws_deflate_context_takeover,
+    "client_no_context_takeover": not config.ws_deflate_context_takeover,
+    "server_max_window_bits": config.ws_deflate_window_bits,
+    "compress_settings": {"level": config.ws_deflate_level, "memLevel": config.ws_deflate_mem_level}
+}
+if config.heartbeat_timeout > 0:
+    DeflateWebSocketProtocol.close_timeout = config.heartbeat_timeout
+
+# With several workers every worker is a shard holding its own clients, global state lives in
+# the broker started by the supervisor process. Single worker keeps everything in process.
+if config.workers > 1:
+    backplane = UnixBackplane(config.backplane_socket, messages, rooms, backplanelogger)
+else:
+    backplane = LocalBackplane(messages, rooms, msglog)
 
-def process_event(etype: str, etrigger: str | None = None, *args, **kwargs):
+# Built once after plugins are loaded: (etype, etrigger) -> [(plugin, event, index, mode, timeout)], in plugin load order.
+# mode is "async" (awaited on the loop), "executor" (sync, worker thread), "process" (sync, plugin process pool)
+# or "inline" (sync, on the loop). Plugins built with older sdk copies have no async/executor/timeout fields and run inline.
+def compile_events():
+    events.clear()
     for x in plugins:
-        for ev in x["obj"].events:
-            if ev.etype == etype and ev.etrigger == etrigger:
-                if ev.etype in ["on_startup", "on_shutdown"]:
-                    try:
-                        cb = ev.callback(config, x["logger"])
-                        if not cb:
-                            pluginslogger.warning(f"Callback returns False in {x['id']}.")
-                    except Exception as e:
-                        pluginslogger.error(f"Got exception when processing {ev.etype} event in {x['id']} plugin: {e}")
-                elif ev.etype == "on_packet":
-                    try:
-                        cb = ev.callback(config, x["logger"], clients, messages, *args, **kwargs)
-                        if not cb:
-                            pluginslogger.warning(f"Callback returns False in {x['id']}.")
-                    except Exception as e:
-                        pluginslogger.error(f"Got exception when processing {ev.etype} event in {x['id']} plugin: {e}")
+        for index, ev in enumerate(x["obj"].events):
+            if ev.etype in ["on_startup", "on_shutdown", "on_packet"]:
+                executor = getattr(ev, "executor", False)
+                if inspect.iscoroutinefunction(ev.callback):
+                    mode = "async"
+                elif executor == "process" and plugin_pool is not None and ev.etype == "on_packet":
+                    mode = "process"
+                elif executor:
+                    mode = "executor"
                 else:
-                    pluginslogger.warning(f"Can't process event for plugin '{x['name']}', invalid etype - {ev.etype}.")
+                    mode = "inline"
+                    # Inline callback blocks the loop, nothing can interrupt it.
+                    if getattr(ev, "timeout", None) is not None:
+                        pluginslogger.warning(f"Timeout of sync {ev.etype} callback in {x['id']} plugin has no effect, make it async or use executor.")
+                timeout = getattr(ev, "timeout", None) or config.plugin_timeout
+                events.setdefault((ev.etype, ev.etrigger), []).append((x, ev, index, mode, timeout))
+            else:
+                pluginslogger.warning(f"Can't process event for plugin '{x['name']}', invalid etype - {ev.etype}.")
+
+async def run_callback(x: dict, ev, index: int, mode: str, timeout: float, *args):
+    if mode == "async":
+        return await asyncio.wait_for(ev.callback(config, x["logger"], *args), timeout)
+    elif mode == "executor":
+        # Worker thread gets copies taken here on the loop, the loop keeps changing the originals meanwhile.
+        if args:
+            connected, history, packet, ws = args
+            args = (set(connected), list(history), packet, ws)
+        return await asyncio.wait_for(asyncio.to_thread(ev.callback, config, x["logger"], *args), timeout)
+    elif mode == "process":
+        # Worker process gets a copy of history and no client set or websocket, they can't be pickled.
+        _, history, packet, _ = args
+        result = await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(
+                plugin_pool, run_hook,
+                config.plugins_directory, x["directory"], x["main"], x["entry"], x["id"], index,
+                config, None, list(history), packet, None
+            ),
+            timeout
+        )
+        if isinstance(result, tuple):
+            _, ptype, puuid, content = result
+            return Packet(ptype, puuid or packet.uuid, **content)
+        return result
+    return ev.callback(config, x["logger"], *args)
+
+# Circuit breaker: a plugin that fails or runs over budget plugin_max_overruns times in a row
+# is skipped for plugin_cooldown seconds. After that one more failure disables it again.
+def check_budget(x: dict, elapsed: float, failed: bool):
+    x["timings"].observe(elapsed)
+    if not failed and elapsed <= config.plugin_budget:
+        x["overruns"] = 0
+        return
+
+    x["overruns"] += 1
+    x["total_overruns"] += 1
+    if x["overruns"] >= config.plugin_max_overruns:
+        x["disabled_until"] = time.monotonic() + config.plugin_cooldown
+        x["overruns"] = config.plugin_max_overruns - 1
+        x["trips"] += 1
+        pluginslogger.error(f"Plugin {x['id']} disabled for {config.plugin_cooldown}s, it failed or exceeded its budget ({config.plugin_budget * 1000:.0f}ms) {config.plugin_max_overruns} times in a row.")
+
+# For on_packet returns packet after all callbacks (plugins may replace it) or None if a plugin dropped it.
+async def process_event(etype: str, etrigger: str | None = None, packet: Packet | None = None, ws: WebSocket | None = None):
+    for x, ev, index, mode, timeout in events.get((etype, etrigger), ()):
+        if x["disabled_until"] > time.monotonic():
+            continue
+
+        args = (clients.connected, messages.messages, packet, ws) if etype == "on_packet" else ()
+        start = time.perf_counter()
+        failed = True
+        try:
+            cb = await run_callback(x, ev, index, mode, timeout, *args)
+            failed = False
+        except asyncio.TimeoutError:
+            pluginslogger.error(f"Callback for {ev.etype} event in {x['id']} plugin timed out ({timeout}s).")
+        except Exception as e:
+            pluginslogger.error(f"Got exception when processing {ev.etype} event in {x['id']} plugin: {e}")
+        if etype == "on_packet":
+            check_budget(x, time.perf_counter() - start, failed)
+        if failed:
+            continue
+
+        if etype == "on_packet":
+            if cb == "drop":
+                pluginslogger.debug(f"Packet '{packet.type}' dropped by {x['id']}.")
+                return None
+            if hasattr(cb, "type") and hasattr(cb, "content"):
+                packet = Packet(cb.type, getattr(cb, "uuid", packet.uuid), **cb.content)
+                continue
+        if not cb:
+            pluginslogger.warning(f"Callback returns False in {x['id']}.")
+    return packet
+
+# Packets nobody subscribed to skip dispatch completely.
+async def dispatch_packet(packet: Packet, ws: WebSocket) -> Packet | None:
+    if ("on_packet", packet.type) not in events:
+        return packet
+
+    ptype = packet.type
+    start = time.perf_counter()
+    packet = await process_event("on_packet", ptype, packet, ws)
+    elapsed = time.perf_counter() - start
+
+    stats = dispatch_stats.setdefault(ptype, [0, 0.0, 0.0])
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] = max(stats[2], elapsed)
+    histogram = metrics.dispatch.get(ptype)
+    if histogram is None:
+        histogram = metrics.dispatch[ptype] = Histogram()
+    histogram.observe(elapsed)
+    return packet
 
 async def lifespan(app: FastAPI):
+    global plugin_pool, reaper_task
     initlogger.info(f"Starting MUCO Server ({__version__}) with config:")
     initlogger.debug(f" - ip: {config.ip}")
     initlogger.debug(f" - port: {config.port}")
     initlogger.debug(f" - server_size: {config.server_size}")
     initlogger.debug(f" - server_message_size: {config.server_message_size}")
-    initlogger.debug(f" - server_history_size: {config.server_history_size}")
+    initlogger.debug(f" - server_history_size: {config.server_history_size} (chunks of {config.history_chunk_size})")
     initlogger.debug(f" - server_nickname: {config.server_nickname}")
     initlogger.debug(f" - server_path: {config.server_path}")
+    initlogger.debug(f" - upload_max_size: {config.upload_max_size}")
+    initlogger.debug(f" - cache: {config.cache_max_bytes} bytes / {config.cache_max_entries} files, memory {config.cache_memory_bytes} bytes (files up to {config.cache_memory_file_size})")
+    initlogger.debug(f" - message_log: {config.message_log_directory if msglog is not None else 'disabled'}")
+    initlogger.debug(f" - codecs: {', '.join(x for x in config.codecs if x in CODECS)}")
+    initlogger.debug(f" - compression: permessage-deflate {f'level {config.ws_deflate_level}, window {config.ws_deflate_window_bits} bits, context takeover {config.ws_deflate_context_takeover}' if config.ws_deflate else 'disabled'}, frames from {config.compression_threshold} bytes")
+    initlogger.debug(f" - batching: {f'every {config.batch_interval}s or {config.batch_size} messages' if config.batch_interval > 0 else 'disabled'}")
+    initlogger.debug(f" - rooms: up to {config.rooms_max} of {config.room_max_size} clients, {config.room_history_size} messages history, {config.client_max_rooms} per client")
+    initlogger.debug(f" - workers: {config.workers}{f' (backplane {config.backplane_socket})' if config.workers > 1 else ''}")
+    initlogger.debug(f" - client_queue: {config.client_queue_size} ({config.client_queue_policy})")
+    initlogger.debug(f" - heartbeat: {f'ping every {config.heartbeat_interval}s, timeout {config.heartbeat_timeout}s' if config.heartbeat_interval > 0 else 'disabled'}, reaper every {config.reaper_interval}s, resume grace {f'{config.resume_grace}s' if resumable else 'disabled'}")
+    initlogger.debug(f" - plugins: timeout {config.plugin_timeout}s, budget {config.plugin_budget}s x{config.plugin_max_overruns}, cooldown {config.plugin_cooldown}s, process pool {config.plugin_process_pool or 'disabled'}")
     initlogger.debug(f" - allow_client_version: {config.allow_client_version}")
     initlogger.debug(f" - tls (certs): {'enabled' if config.certs is not None else 'disabled'}")
     os.makedirs(config.plugins_directory, exist_ok=True)
     os.makedirs(config.errorlog_directory, exist_ok=True)
     os.makedirs(config.cache_directory, exist_ok=True)
+    media.start()
+    cachelogger.info(f"Indexed {len(media.index)} cached files ({media.size} bytes).")
+
+    backplane.on_message = lambda message, room: broadcast(**message, room=room)
+    backplane.on_private = deliver_private
+    backplane.on_media = lambda fileid, media_type: media.ready(fileid, media_type, announce=False)
+    media.on_store = backplane.media
+    if msglog is not None or config.workers > 1:
+        initlogger.info("Restoring chat history...")
+    await backplane.start()
+    if msglog is not None or config.workers > 1:
+        initlogger.info(f"Restored {len(messages)} messages (last seq is {messages.seq}).")
+    reaper_task = asyncio.create_task(reaper())
 
     pluginslogger.info("Loading plugins...")
-    sys.path.insert(0, config.plugins_directory)
     for plugin in os.listdir(config.plugins_directory):
         plugincfg = os.path.join(config.plugins_directory, plugin, "index.json")
         if os.path.exists(plugincfg):
@@ -143,14 +388,7 @@ async def lifespan(app: FastAPI):
                         pluginslogger.warning(f"Can't load {plugin}, invalid manifest.")
                     else:
                         try:
-                            spec = importlib.util.spec_from_file_location(
-                                f"{plugin}.{entry.removesuffix('.py')}",
-                                os.path.abspath(os.path.join(config.plugins_directory, plugin, mainfile))
-                            )
-                            module = importlib.util.module_from_spec(spec)
-                            module.__package__ = plugin
-                            spec.loader.exec_module(module)
-                            pluginobj = getattr(module, entry)
+                            pluginobj = load_plugin(config.plugins_directory, plugin, mainfile, entry)
 
                             pluginlogger = logging.getLogger(f"plugins::{id}")
                             pluginlogger.setLevel(config.log_level)
@@ -161,25 +399,40 @@ async def lifespan(app: FastAPI):
                                 "name" : name,
                                 "version" : version,
                                 "obj" : pluginobj,
-                                "logger" : pluginlogger
+                                "logger" : pluginlogger,
+                                "directory" : plugin,
+                                "main" : mainfile,
+                                "entry" : entry,
+                                "timings" : Histogram(),
+                                "overruns" : 0,
+                                "total_overruns" : 0,
+                                "trips" : 0,
+                                "disabled_until" : 0.0
                             })
                             pluginslogger.info(f"Loaded '{plugin}' plugin.")
                         except Exception as e:
                             pluginslogger.error(f"Can't load {plugin}, invalid manifest values (wrong entry?): {e}")       
         else:
             pluginslogger.warning(f"Ignoring '{plugin}' (index.json not found).")
-    sys.path.pop(0)
+    if config.plugin_process_pool > 0 and any(getattr(ev, "executor", False) == "process" for x in plugins for ev in x["obj"].events):
+        plugin_pool = ProcessPoolExecutor(config.plugin_process_pool)
+        pluginslogger.info(f"Started plugin process pool ({config.plugin_process_pool} workers).")
+    compile_events()
     pluginslogger.info("Initializing plugins...")
-    process_event("on_startup")
+    await process_event("on_startup")
+
+    if config.legacy_media_parser and not LEGACY_PARSER:
+        initlogger.warning("Requirements for legacy tag formatting (img/video/audio) not installed, using built-in extractor. For legacy parser install bs4 and lxml libs: pip install beautifulsoup4 lxml")
 
-    serverip = socket.gethostbyname(socket.gethostname())
     initlogger.info(f"Server link: ws{'s' if config.certs is not None else ''}://{serverip}:{config.port}{config.server_path}")
     initlogger.info("Done! Server started.")
     yield
     shutdownlogger.info("Shutting down MUCO Server...")
-    process_event("on_shutdown")
+    await process_event("on_shutdown")
+    reaper_task.cancel()
+    flush_batches()
 
-    for x in connecting:
+    for x in tuple(clients.connecting):
         await x.ws.send_text(
             ConnectionClose(
                 x.server_uuid
@@ -188,12 +441,19 @@ async def lifespan(app: FastAPI):
         await x.ws.close()
 
     for x in clients:
-        await x.ws.send_text(
+        x.send(
             ConnectionClose(
                 x.server_uuid
-            ).wsPacket
+            )
         )
-        await x.ws.close()
+        x.close()
+    writers = [x.writer for x in clients if x.writer is not None]
+    if writers:
+        await asyncio.wait(writers, timeout=5)
+
+    await backplane.close()
+    if plugin_pool is not None:
+        plugin_pool.shutdown(cancel_futures=True)
     
     config.save()
     
@@ -205,121 +465,559 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-def isLxmlInstalled():
-    try:
-        import lxml
-        return True
-    except: return False
+def cached_url(fileid: str, host: str | None = None):
+    return f"http{'' if config.certs is None else 's'}://{serverip if host is None else host}{':'+str(config.port) if host is None else ''}{config.server_path if config.server_path.endswith('/') else config.server_path+'/'}cached/{fileid}"
 
 # Uploading files with base64 in messages is very unefficient, slow and deprecated for now, but still supported for older clients as legacy upload method.
 # New method is upload via post http request, native way to upload files in web.
-def process_message(message: Packet, host: str | None = None):
-    bs4 = BeautifulSoup(message["text"], "lxml")
-    for tag in bs4.find_all(["img", "video", "audio"]):
-        if tag.get("src", "").startswith("data:") and "base64" in tag["src"]:
-            rawbase64 = tag["src"].split(";")
-            rawdata = base64.b64decode(rawbase64[-1].split(",")[-1])
-
-            fileid = hashlib.sha256(rawdata).hexdigest()
-            with open(os.path.join(config.cache_directory, fileid), "wb") as f:
-                f.write(rawdata)
-            tag["src"] = f"http{'' if config.certs is None else 's'}://{socket.gethostbyname(socket.gethostname()) if host is None else host}{':'+str(config.port) if host is None else ''}{config.server_path if config.server_path.endswith('/') else config.server_path+'/'}cached/{fileid}"
-    return str(bs4)
-
-async def broadcast(text: str, author: str, id: int):
-
-    tasks = []
-    for x in clients.copy():
-        if x.ws.client_state == WebSocketState.DISCONNECTED:
-            clients.discard(x)
+async def process_message(message: Packet, host: str | None = None):
+    url = lambda fileid: cached_url(fileid, host)
+    if config.legacy_media_parser and LEGACY_PARSER:
+        return await asyncio.to_thread(media.extract_legacy, message["text"], url)
+    return await media.extract(message["text"], url, config.upload_max_size)
+
+async def client_writer(client: ClientData):
+    try:
+        while True:
+            client.last_write = time.monotonic()
+            if client.resync:
+                client.resync = False
+                wslogger.debug(f"Client {client.client_uuid} send queue coalesced, resending history.")
+                frames = [messages.snapshot().frameFor(client)]
+                for name in tuple(client.rooms):
+                    joined = rooms.get(name)
+                    if joined is not None:
+                        frames.append(joined.history.snapshot(room=name).frameFor(client))
+                for frame in frames:
+                    await (client.ws.send_bytes if isinstance(frame, bytes) else client.ws.send_text)(frame)
+            elif client.outbox:
+                frame, _ = client.outbox.popleft()
+                if frame is None:
+                    if client.close_reason is None:
+                        await client.ws.close()
+                    else:
+                        await client.ws.close(1008, client.close_reason)
+                    break
+                elif isinstance(frame, bytes):
+                    await client.ws.send_bytes(frame)
+                else:
+                    await client.ws.send_text(frame)
+            else:
+                client.outbox_ready.clear()
+                await client.outbox_ready.wait()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        wslogger.debug(f"Writer for client {client.client_uuid} stopped: {e}")
+        clients.remove(client)
+
+def evict(client: ClientData, reason: str):
+    wslogger.debug(f"Evicting client {client.client_uuid} ({client.nickname}): {reason}.")
+    clients.remove(client)
+    client.closing = True
+    client.outbox.clear()
+    if client.writer is not None:
+        client.writer.cancel()
+    asyncio.create_task(client.ws.close(1008, reason))
+
+# Streams messages after cursor in chunks of history_chunk_size, every chunk carries
+# "next" cursor and "more" flag (there are messages after "next").
+def send_history(client: ClientData, cursor: int, limit: int, history: MessageHistory = messages, room: str | None = None):
+    remaining = min(limit, history.messages.maxlen)
+    start = history.index(cursor)
+    while True:
+        count = max(0, min(remaining, config.history_chunk_size, len(history) - start))
+        remaining -= count
+        if count:
+            cursor = history.messages[start + count - 1]["seq"]
+        more = history.has_after(cursor)
+        page = history.page(start, start + count, next=cursor, more=more, **({} if room is None else {"room": room}))
+        client.send(page.frameFor(client))
+        start += count
+        if remaining <= 0 or not more:
+            break
+
+# Room messages go only to room members and carry the room name.
+# Shared packets carry only history messages, so a coalesced queue drops them for the resync.
+def send_shared(client: ClientData, packet: SharedPacket):
+    if not client.send(packet.frameFor(client), covered=True):
+        evict(client, "send queue overflow")
+
+# Clients that asked for batching get messages in "messages" packets, flushed every batch_interval
+# seconds or when batch_size messages are pending, legacy clients get every message at once.
+async def broadcast(text: str, author: str, id: int, seq: int, room: str | None = None):
+    global batch_timer
+    if room is None:
+        targets = clients
+    else:
+        joined = rooms.get(room)
+        if joined is None:
+            return
+        targets = tuple(joined.members)
+
+    start = time.perf_counter()
+    packet = None
+    sent = 0
+    for x in targets:
+        if not x.batch:
+            if packet is None:
+                packet = SharedPacket("message", text=text, author=author, id=id, seq=seq, **({} if room is None else {"room": room}))
+            send_shared(x, packet)
+            sent += 1
+    if sent:
+        metrics.fanout["immediate"].observe(time.perf_counter() - start)
+        metrics.frames += sent
+
+    if config.batch_interval > 0:
+        batch = batches.setdefault(room, [])
+        batch.append({"text": text, "author": author, "id": id, "seq": seq})
+        if len(batch) >= config.batch_size:
+            flush_batch(room)
+        elif batch_timer is None:
+            batch_timer = asyncio.get_running_loop().call_later(config.batch_interval, flush_batches)
+
+def flush_batch(room: str | None):
+    batch = batches.pop(room, None)
+    if not batch:
+        return
+    start = time.perf_counter()
+    if room is None:
+        targets = [x for x in clients if x.batch]
+    else:
+        joined = rooms.get(room)
+        targets = [] if joined is None else [x for x in joined.members if x.batch]
+    if not targets:
+        return
+
+    packet = SharedPacket("messages", messages=batch, **({} if room is None else {"room": room}))
+    for x in targets:
+        send_shared(x, packet)
+    metrics.fanout["batch"].observe(time.perf_counter() - start)
+    metrics.frames += len(targets)
+
+def flush_batches():
+    global batch_timer
+    if batch_timer is not None:
+        batch_timer.cancel()
+        batch_timer = None
+    for room in tuple(batches):
+        flush_batch(room)
+
+def notify(client: ClientData, text: str):
+    client.send(
+        Message(
+            client.server_uuid,
+            text,
+            config.server_nickname,
+            int(time.time())
+        )
+    )
+
+def attach_limiter(client: ClientData, host: str):
+    if client.limiter is None:
+        client.limiter = RateLimiter(config.rate_limits)
+    entry = ip_limiters.get(host)
+    if entry is None:
+        entry = ip_limiters[host] = [0, RateLimiter(config.rate_limits_ip)]
+    entry[0] += 1
+
+def detach_limiter(host: str):
+    entry = ip_limiters.get(host)
+    if entry is not None:
+        entry[0] -= 1
+        if entry[0] <= 0:
+            del ip_limiters[host]
+
+# Returns False when the packet has to be dropped. Every dropped packet is a strike, client is
+# disconnected on rate_limit_strikes strikes with less than strike window between them.
+def rate_limit(client: ClientData, host: str, ptype: str) -> bool:
+    now = time.monotonic()
+    if client.limiter.allow(ptype, now) and ip_limiters[host][1].allow(ptype, now):
+        return True
+    metrics.limited += 1
+    strikes = client.limiter.strike(now, config.rate_limit_strike_window)
+    if strikes >= config.rate_limit_strikes:
+        wslogger.debug(f"Client {client.client_uuid} ({client.nickname}) exceeded rate limit {strikes} times. Disconnecting.")
+        notify(client, "Слишком много запросов. Соединение закрыто.")
+        clients.remove(client)
+        client.send(ConnectionClose(client.server_uuid))
+        client.close()
+        return False
+    wslogger.debug(f"Client {client.client_uuid} ({client.nickname}) exceeded rate limit for {ptype}, dropping packet.")
+    notify(client, "Слишком много запросов, подождите немного.")
+    return False
+
+def not_in_room(client: ClientData, room):
+    notify(client, f"Вы не находитесь в комнате '{room}'.")
+
+def leave_room(client: ClientData, room: str):
+    if rooms.leave(client, room):
+        backplane.close_room(room)
+
+# Joins the room, creating it if needed. Client is notified if it's not possible.
+async def enter_room(client: ClientData, room: str) -> Room | None:
+    joined = rooms.get(room)
+    if joined is None and len(rooms) < config.rooms_max:
+        joined = rooms.create(room)
+        if not await backplane.open_room(joined):
+            rooms.leave(client, room)
+            joined = None
+
+    if joined is None:
+        notify(client, f"Достигнут лимит комнат на сервере ({config.rooms_max}).")
+    elif len(joined.members) >= config.room_max_size:
+        notify(client, f"Комната '{room}' заполнена.")
+        return None
+    else:
+        # Pending room batch is already in the room history sent on join, it goes out before the client is a member.
+        flush_batch(room)
+        rooms.join(client, joined)
+    return joined
+
+# Options the client asked for in connmeta and the server supports are echoed in connaccept.
+def negotiate_options(client: ClientData, packet: Packet) -> dict:
+    options = {}
+    if packet.content.get("batch") is True and config.batch_interval > 0:
+        client.batch = options["batch"] = True
+    if packet.content.get("compress") is True and config.compression_threshold > 0:
+        client.compress = (config.compression_threshold, config.compression_level)
+        options["compress"] = True
+    if "codecs" in packet.content:
+        client.codec = negotiate(packet["codecs"], config.codecs)
+        options["codec"] = client.codec.name
+    return options
+
+def release_nickname(client: ClientData):
+    # Nickname may already belong to the client that resumed this session.
+    if client.nickname is not None and clients.get_nickname(client.nickname) is None:
+        backplane.release(client.nickname)
+
+def expire_session(client: ClientData):
+    if client.state == "parked":
+        wslogger.debug(f"Session of {client.client_uuid} ({client.nickname}) expired.")
+        clients.remove(client)
+        release_nickname(client)
+
+# Dead connections are closed by uvicorn when pings (heartbeat_interval) get no pong in heartbeat_timeout,
+# the handler then cleans the client up. The reaper is one task sweeping in batches whatever is left:
+# registered clients with a closed socket or a dead writer, writers stuck on a socket that doesn't
+# take data and parked sessions past their grace window.
+def reap(now: float):
+    closed = []
+    stalled = []
+    for x in clients:
+        if x.ws.client_state == WebSocketState.DISCONNECTED or (x.writer is not None and x.writer.done()):
+            closed.append(x)
+        elif config.heartbeat_timeout > 0 and x.outbox and now - x.last_write > config.heartbeat_timeout:
+            stalled.append(x)
+    expired = [x for x in clients.sessions.values() if x.state == "parked" and x.parked_until <= now]
+
+    for x in closed:
+        clients.remove(x)
+        if x.writer is not None:
+            x.writer.cancel()
+    # Not evicted: the handler parks resumable clients once the socket is closed.
+    for x in stalled:
+        clients.remove(x)
+        if x.writer is not None:
+            x.writer.cancel()
+        asyncio.create_task(x.ws.close(1011, "send timeout"))
+    for x in expired:
+        expire_session(x)
+
+    if closed or stalled or expired:
+        wslogger.debug(f"Reaped {len(closed)} closed, {len(stalled)} stalled connections and {len(expired)} expired sessions.")
+        reaped["closed"] += len(closed)
+        reaped["stalled"] += len(stalled)
+        reaped["expired"] += len(expired)
+
+async def reaper():
+    while True:
+        await asyncio.sleep(config.reaper_interval)
+        reap(time.monotonic())
+
+# New connection takes the session over: server uuid, nickname, rooms and rate limits stay the same,
+# the client gets only messages after the cursors it sent ("from" and "rooms": {room: seq}).
+# A still registered old socket (not noticed dead yet) is closed.
+# Nothing awaits between registering the client and queueing its catch-up history, so no message
+# can reach it both ways.
+async def resume_session(session: ClientData, client: ClientData, packet: Packet, host: str):
+    # Pending batches go out before the client is registered again, the history sent below covers them.
+    flush_batches()
+    live = session.state == "connected"
+    clients.resume(session, client)
+    client.server_uuid = session.server_uuid
+    client.limiter = session.limiter
+    attach_limiter(client, host)
+    if live:
+        for name in tuple(session.rooms):
+            joined = rooms.get(name)
+            joined.members.discard(session)
+            rooms.join(client, joined)
+        session.rooms.clear()
+        evict(session, "session resumed")
+
+    options = negotiate_options(client, packet)
+    # Queued instead of sent, connaccept is still the first frame and always JSON.
+    client.send(
+        ConnectionAccept(
+            client.server_uuid,
+            resumed=True,
+            resume=client.token,
+            epoch=messages.epoch,
+            **options
+        ).wsPacket
+    )
+    client.writer = asyncio.create_task(client_writer(client))
+
+    # Resumable sessions exist only with the local backplane, opening a room doesn't wait on anything.
+    if not live:
+        for name in session.parked_rooms:
+            await enter_room(client, name)
+
+    cursor = packet.content.get("from")
+    if isinstance(cursor, int):
+        send_history(client, cursor if cursor <= messages.seq else 0, messages.messages.maxlen)
+    cursors = packet.content.get("rooms")
+    for name in tuple(client.rooms):
+        history = rooms.get(name).history
+        cursor = cursors.get(name) if isinstance(cursors, dict) else None
+        if isinstance(cursor, int):
+            send_history(client, cursor if cursor <= history.seq else 0, history.messages.maxlen, history, name)
         else:
-            tasks.append(
-                x.ws.send_text(
-                    Message(
-                        x.server_uuid,
-                        text,
-                        author,
-                        id
-                    ).wsPacket
-                )
-            )
-    await asyncio.gather(*tasks, return_exceptions=True)
+            client.send(history.snapshot(room=name).frameFor(client))
+
+# Private message for a client of this shard sent from another shard.
+def deliver_private(touser: str, author: str, text: str) -> bool:
+    client = clients.get_nickname(touser)
+    if client is None:
+        return False
+    client.send(
+        Message(
+            client.server_uuid,
+            text,
+            f"{author}=>",
+            int(time.time())
+        )
+    )
+    return True
+
+@app.get((config.server_path if config.server_path.endswith('/') else config.server_path+'/')+"stats")
+async def getStats():
+    return {
+        "worker": os.getpid(),
+        "handshakes": handshakes,
+        "parked": sum(1 for x in clients.sessions.values() if x.state == "parked"),
+        "reaped": reaped,
+        # client_uuid is what /upload authenticates with, it must not be listed here.
+        "clients": [
+            {
+                "nickname": x.nickname,
+                "queued": x.queued,
+                "dropped": x.dropped,
+                "limited": x.limiter.limited if x.limiter is not None else 0
+            } for x in clients
+        ],
+        "rooms": {name: len(x.members) for name, x in rooms.rooms.items()},
+        "cache": media.stats,
+        "dispatch": {
+            ptype: {
+                "count": count,
+                "avg_ms": total / count * 1000,
+                "max_ms": peak * 1000
+            } for ptype, (count, total, peak) in dispatch_stats.items()
+        },
+        "plugins": {
+            x["id"]: {
+                "latency": x["timings"].snapshot,
+                "overruns": x["total_overruns"],
+                "trips": x["trips"],
+                "disabled": x["disabled_until"] > time.monotonic()
+            } for x in plugins
+        }
+    }
+
+# Prometheus scrape endpoint, rates (packets per second etc.) come from the counters.
+@app.get((config.server_path if config.server_path.endswith('/') else config.server_path+'/')+"metrics")
+async def getMetrics():
+    now = time.monotonic()
+    parked = sum(1 for x in clients.sessions.values() if x.state == "parked")
+    queued = [x.queued for x in clients]
+    cache = media.stats
+
+    out = Exposition()
+    out.metric("muco_clients", "gauge", "Clients by state.", [
+        ({"state": "connected"}, len(clients)),
+        ({"state": "connecting"}, len(clients.connecting)),
+        ({"state": "parked"}, parked)
+    ])
+    out.metric("muco_handshakes", "gauge", "Connections admitted and not done with the handshake.", [(None, handshakes)])
+    out.metric("muco_packets_received_total", "counter", "Packets received from clients by type.", [({"type": k}, v) for k, v in metrics.packets.items()])
+    out.metric("muco_rate_limited_total", "counter", "Packets dropped by rate limits.", [(None, metrics.limited)])
+    out.histogram("muco_broadcast_fanout_seconds", "Time to queue one broadcast to all recipients.", [({"mode": k}, v) for k, v in metrics.fanout.items()])
+    out.metric("muco_broadcast_frames_total", "counter", "Frames queued by broadcasts.", [(None, metrics.frames)])
+    out.metric("muco_send_queue_frames", "gauge", "Frames waiting in client send queues.", [(None, sum(queued))])
+    out.metric("muco_send_queue_frames_max", "gauge", "Longest client send queue.", [(None, max(queued, default=0))])
+    out.metric("muco_reaped_total", "counter", "Connections dropped by the reaper.", [({"reason": k}, v) for k, v in reaped.items()])
+    out.metric("muco_history_messages", "gauge", "Messages in history.", [({"room": ""}, len(messages))] + [({"room": name}, len(x.history)) for name, x in rooms.rooms.items()])
+    out.metric("muco_history_seq", "gauge", "Last message sequence number.", [(None, messages.seq)])
+    out.metric("muco_rooms", "gauge", "Open rooms.", [(None, len(rooms))])
+    out.histogram("muco_dispatch_seconds", "Plugin on_packet dispatch time by packet type.", [({"type": k}, v) for k, v in metrics.dispatch.items()])
+    out.histogram("muco_plugin_callback_seconds", "Plugin callback time.", [({"plugin": x["id"]}, x["timings"]) for x in plugins])
+    out.metric("muco_plugin_overruns_total", "counter", "Plugin callbacks over plugin_budget.", [({"plugin": x["id"]}, x["total_overruns"]) for x in plugins])
+    out.metric("muco_plugin_disabled", "gauge", "Plugins disabled by the circuit breaker.", [({"plugin": x["id"]}, int(x["disabled_until"] > now)) for x in plugins])
+    out.metric("muco_upload_bytes_total", "counter", "Bytes of uploaded and extracted media accepted by the cache.", [(None, cache["stored_bytes"])])
+    out.metric("muco_uploads_total", "counter", "Uploaded and extracted media files.", [(None, cache["stored"])])
+    out.metric("muco_cache_requests_total", "counter", "Cached file requests by result.", [
+        ({"result": "memory_hit"}, cache["memory_hits"]),
+        ({"result": "disk_hit"}, cache["hits"] - cache["memory_hits"]),
+        ({"result": "miss"}, cache["misses"])
+    ])
+    out.metric("muco_cache_evictions_total", "counter", "Files evicted from the disk cache.", [(None, cache["evictions"])])
+    out.metric("muco_cache_bytes", "gauge", "Cache size.", [({"tier": "disk"}, cache["bytes"]), ({"tier": "memory"}, cache["memory_bytes"])])
+    out.metric("muco_cache_entries", "gauge", "Cached files.", [({"tier": "disk"}, cache["entries"]), ({"tier": "memory"}, cache["memory_entries"])])
+    return PlainTextResponse(out.render(), media_type="text/plain; version=0.0.4")
 
 @app.get((config.server_path if config.server_path.endswith('/') else config.server_path+'/')+"cached/{unique_id}")
-async def getCached(unique_id: str):
+async def getCached(unique_id: str, request: Request):
     cachelogger.debug(f"Got request for cached {unique_id}.")
 
-    isCached = os.path.exists(os.path.join(config.cache_directory, unique_id))
-    if not isCached:
-        cachelogger.debug(f"Request freezed, file {unique_id} is not ready (path not exists: {os.path.join(config.cache_directory, unique_id)})")
-    while not isCached:
-        isCached = os.path.exists(os.path.join(config.cache_directory, unique_id))
-        await asyncio.sleep(1)
+    if not media.valid(unique_id):
+        return Response(status_code=404)
+
+    # Files are content-addressed, so the id is a strong ETag and content never changes.
+    headers = {
+        "ETag": f'"{unique_id}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes"
+    }
+    match = request.headers.get("if-none-match")
+    if match is not None and (match.strip() == "*" or unique_id in [x.strip().removeprefix("W/").strip('"') for x in match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    if not media.exists(unique_id):
+        cachelogger.debug(f"Request freezed, file {unique_id} is not ready (path not exists: {media.path(unique_id)})")
+        if not await media.wait(unique_id, config.cache_wait_timeout):
+            cachelogger.debug(f"File {unique_id} is not ready after {config.cache_wait_timeout}s.")
+            return Response(status_code=404)
     
     try:
+        # Range requests (video/audio seeking) are served from disk, FileResponse handles
+        # single and multipart ranges, If-Range and 416 responses.
+        if "range" not in request.headers:
+            data = await media.get(unique_id)
+            if data is not None:
+                return Response(data, headers=headers, media_type=media.media_type(unique_id))
+        else:
+            media.touch(unique_id)
         return FileResponse(
-            os.path.join(config.cache_directory, unique_id)
+            media.path(unique_id),
+            headers=headers,
+            media_type=media.media_type(unique_id)
         )
     except Exception as e:
         cachelogger.warning(f"Got exception: {e}")
-        Response(status_code=204)
+        return Response(status_code=204)
+
+# Rejects oversized uploads by Content-Length before the body is received.
+# Multipart framing is allowed on top of the limit, the exact size is checked while streaming.
+@app.middleware("http")
+async def limitUpload(request: Request, call_next):
+    if request.method == "POST" and request.url.path == (config.server_path if config.server_path.endswith('/') else config.server_path+'/')+"upload":
+        length = request.headers.get("content-length")
+        if length is not None and length.isdigit() and int(length) > config.upload_max_size + 64 * 1024:
+            cachelogger.debug(f"Uploading rejected: content-length {length} is bigger than {config.upload_max_size} bytes.")
+            return Response("file too large", status_code=413)
+    return await call_next(request)
 
 @app.post((config.server_path if config.server_path.endswith('/') else config.server_path+'/')+"upload")
 async def uploadCache(clientId: str = Form(...), file: UploadFile = File(...)):
-    cl = None
-    for x in clients:
-        if x.client_uuid == clientId:
-            cl = x
-            break
-    if not cl: return Response(status_code=400)
-    cachelogger.debug(f"Uploading file from client '{cl.nickname}' ({cl.client_uuid}).")
+    # Upload request may come to another worker than the client's websocket.
+    cl = clients.get_uuid(clientId)
+    nickname = cl.nickname if cl is not None else await backplane.lookup(clientId)
+    if nickname is None: return Response(status_code=400)
+    cachelogger.debug(f"Uploading file from client '{nickname}' ({clientId}).")
 
     ftype = None
     if file.content_type is None:
-        cachelogger.debug(f"Uploading failed from client '{cl.nickname}' ({cl.client_uuid}): content_type required.")
+        cachelogger.debug(f"Uploading failed from client '{nickname}' ({clientId}): content_type required.")
         return Response("content_type required", status_code=400)
     for x in ["image", "video", "audio"]:
         if file.content_type.startswith(x):
             ftype = file.content_type
             break
     if ftype is None:
-        cachelogger.debug(f"Uploading failed from client '{cl.nickname}' ({cl.client_uuid}): unsupported content_type.")
+        cachelogger.debug(f"Uploading failed from client '{nickname}' ({clientId}): unsupported content_type.")
         return Response("unsupported content_type", status_code=400)
 
-    content = await file.read()
-    fileid = hashlib.sha256(content).hexdigest()
-    with open(os.path.join(config.cache_directory, fileid), "wb") as f:
-        cachelogger.debug(f"CONTENT SIZE: {len(content)}")
-        cachelogger.debug(f"Writting content to: {os.path.join(config.cache_directory, fileid)}")
-        f.write(content)
+    fileid = await media.store(file, config.upload_max_size, ftype)
+    if fileid is None:
+        cachelogger.debug(f"Uploading failed from client '{nickname}' ({clientId}): file is bigger than {config.upload_max_size} bytes.")
+        return Response("file too large", status_code=413)
     
-    cachelogger.debug(f"Uploading done from client '{cl.nickname}' ({cl.client_uuid}), new file is '{fileid}' ({ftype}).")
+    cachelogger.debug(f"Uploading done from client '{nickname}' ({clientId}), new file is '{fileid}' ({ftype}).")
     return PlainTextResponse(fileid)
 
 @app.websocket(config.server_path)
 async def handler(ws: WebSocket):
-    await ws.accept()
-
-    server_uuid = uuid.uuid4().__str__()
-    await ws.send_text(
-        ConnectionMeta(
-            server_uuid,
-            config.allow_client_version,
-            config.server_nickname
-        ).wsPacket
-    )
+    global handshakes
 
-    wslogger.debug(f"New connection. Sent connmeta and generated server uuid: {server_uuid}.")
+    # Admission control, pending handshakes hold a slot too, so a reconnect storm can't
+    # go over server_size. Rejected connections get nothing allocated.
+    if len(clients) + handshakes >= shard_size:
+        reason = "server is full"
+    elif handshakes >= shard_max_pending:
+        reason = "server is busy, try again later"
+    else:
+        reason = None
+    if reason is not None:
+        wslogger.debug(f"New connection rejected: {reason} ({len(clients)} clients, {handshakes} handshakes).")
+        await ws.accept()
+        await ws.send_text(ConnectionReject("", reason).wsPacket)
+        await ws.close(1013)
+        return
 
+    handshakes += 1
+    handshaking = True
+    client = None
     try:
-        while True:
-            data = json.loads(await ws.receive_text())
-            datatype = data.get("type")
-            client_uuid = data.get("uuid")
+        await ws.accept()
 
-            data.pop("type")
-            data.pop("uuid")
-            packet = Packet(datatype, client_uuid, **data)
+        server_uuid = uuid.uuid4().__str__()
+        host = ws.client.host if ws.client is not None else ""
+        await ws.send_text(
+            ConnectionMeta(
+                server_uuid,
+                config.allow_client_version,
+                config.server_nickname
+            ).wsPacket
+        )
+
+        wslogger.debug(f"New connection. Sent connmeta and generated server uuid: {server_uuid}.")
+
+        deadline = time.monotonic() + config.handshake_timeout
+        while True:
+            if handshaking:
+                try:
+                    frame = await asyncio.wait_for(ws.receive(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    wslogger.debug(f"Handshake timeout for {server_uuid}. Closing connection.")
+                    await ws.send_text(
+                        ConnectionReject(
+                            server_uuid,
+                            "handshake timeout"
+                        ).wsPacket
+                    )
+                    await ws.close()
+                    break
+            else:
+                frame = await ws.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            packet = Packet.decode(frame.get("text"), frame.get("bytes"))
+            datatype = packet.type
+            client_uuid = packet.uuid
+            metrics.packet(datatype)
 
             if datatype is None:
                 await ws.close(1000, "unknown packet type")
@@ -335,61 +1033,84 @@ async def handler(ws: WebSocket):
                 await ws.close()
                 break
             
-            client = None
-            for x in connecting.copy():
-                if x.ws.client_state == WebSocketState.DISCONNECTED:
-                    connecting.discard(x)
-                elif x.ws == ws and x.client_uuid == client_uuid:
-                    client = x
-                    break
-            else:
-                for x in clients.copy():
-                    if x.ws.client_state == WebSocketState.DISCONNECTED:
-                        clients.discard(x)
-                    elif x.ws == ws and x.client_uuid == client_uuid:
-                        client = x
-                        break
+            if client is not None and client.client_uuid != client_uuid:
+                wslogger.debug(f"Client {client.client_uuid} sent packet with foreign uuid {client_uuid}. Ignoring packet.")
+                continue
 
             if client is None:
                 wslogger.debug(f"Unknown client detected. Processing to new client: {client_uuid} / {server_uuid}.")
                 client = ClientData(
                     ws,
                     client_uuid,
-                    server_uuid
+                    server_uuid,
+                    queue_size=config.client_queue_size,
+                    queue_policy=config.client_queue_policy
                 )
-                connecting.add(client)
+                clients.add(client)
+
+            # Checked before plugins and any other work on the packet.
+            if client.limiter is not None and not rate_limit(client, host, datatype):
+                if client.closing:
+                    break
+                continue
 
-            await asyncio.to_thread(process_event, "on_packet", packet.type, packet, ws)
-            if client in connecting:
+            packet = await dispatch_packet(packet, ws)
+            if packet is None:
+                continue
+            if client.state == "connecting":
                 if packet.type == "connmeta":
                     wslogger.debug(f"Got connmeta from {client.client_uuid} client.")
+
+                    session = clients.session(packet.content.get("token")) if resumable else None
+                    if session is not None and session.client_uuid == client.client_uuid and packet["version"] == config.allow_client_version:
+                        wslogger.debug(f"Client {client.client_uuid} resumed session of {session.nickname}.")
+                        handshaking = False
+                        handshakes -= 1
+                        await resume_session(session, client, packet, host)
+                        continue
                     
-                    for x in clients:
-                        if x.nickname == packet["nickname"] and x.ws.client_state != WebSocketState.DISCONNECTED:
-                            wslogger.debug(f"Client {client.client_uuid} using same nickname as {x.client_uuid}. Rejecting connection.")
-                            await ws.send_text(
-                                ConnectionReject(
-                                    client.server_uuid,
-                                    "nickname already taken, change nickname"
-                                ).wsPacket
-                            )
-                            await ws.close()
-                            break
+                    taken = clients.get_nickname(packet["nickname"])
+                    # Same client reconnecting without its token, its parked session is not needed anymore.
+                    if taken is not None and taken.state == "parked" and taken.client_uuid == client.client_uuid:
+                        expire_session(taken)
+                        taken = None
+                    if taken is not None or not await backplane.claim(packet["nickname"], client.client_uuid):
+                        wslogger.debug(f"Client {client.client_uuid} using nickname of another client ({packet['nickname']}). Rejecting connection.")
+                        clients.remove(client)
+                        await ws.send_text(
+                            ConnectionReject(
+                                client.server_uuid,
+                                "nickname already taken, change nickname"
+                            ).wsPacket
+                        )
+                        await ws.close()
+                        break
                     
                     if packet["version"] == config.allow_client_version:
                         wslogger.debug(f"Client {client.client_uuid} using allowed version. Accepting connection.")
+                        # Pending batches are already in history, they go out before the client is a batch target,
+                        # so it gets them only in the history it asks for.
+                        flush_batches()
+                        clients.accept(client, packet["nickname"])
+                        handshaking = False
+                        handshakes -= 1
+                        attach_limiter(client, host)
+                        options = negotiate_options(client, packet)
+                        if packet.content.get("resume") is True and resumable:
+                            clients.issue(client, secrets.token_urlsafe(16))
+                            options["resume"] = client.token
                         await ws.send_text(
                             ConnectionAccept(
-                                server_uuid
+                                server_uuid,
+                                epoch=messages.epoch,
+                                **options
                             ).wsPacket
                         )
-                        connecting.discard(client)
-
-                        client.nickname = packet["nickname"]
-                        clients.add(client)
+                        client.writer = asyncio.create_task(client_writer(client))
                     else:
                         wslogger.debug(f"Client {client.client_uuid} using wrong version - {packet['version']} ({config.allow_client_version} allowed). Rejecting connection.")
-                        connecting.discard(client)
+                        clients.remove(client)
+                        backplane.release(packet["nickname"])
                         await ws.send_text(
                             ConnectionReject(
                                 server_uuid,
@@ -400,183 +1121,258 @@ async def handler(ws: WebSocket):
                         break
                 else:
                     wslogger.debug(f"Client {client.client_uuid} sent unknown packet type - {packet.type}. Closing connection.")
-                    connecting.discard(client)
+                    clients.remove(client)
                     await ws.send_text(
                         ConnectionClose(
                             server_uuid
                         ).wsPacket
                     )
                     await ws.close()
+                    break
             
             else:
                 if packet.type == "getHistory":
                     wslogger.debug(f"Client {client.client_uuid} requested server history.")
-                    await ws.send_text(
-                        History(
-                            server_uuid,
-                            list(messages)
-                        ).wsPacket
-                    )
+                    room = packet.content.get("room")
+                    if room is not None and room not in client.rooms:
+                        not_in_room(client, room)
+                    else:
+                        # Messages sent after connaccept or join may still be batched, they are in the history too.
+                        if client.batch:
+                            flush_batch(room)
+                        history = messages if room is None else rooms.get(room).history
+                        cursor = packet.content.get("from")
+                        limit = packet.content.get("limit")
+                        if isinstance(limit, int) and limit > 0:
+                            # Cursor from another epoch or from the future means the history was reset, resend from the beginning.
+                            epoch = packet.content.get("epoch")
+                            if not isinstance(cursor, int) or cursor > history.seq or (epoch is not None and epoch != history.epoch):
+                                cursor = 0
+                            # Catching up after a long gap: only the newest limit messages, seq has no holes.
+                            if packet.content.get("latest") is True:
+                                cursor = max(cursor, history.seq - limit)
+                            send_history(client, cursor, limit, history, room)
+                        else:
+                            content = {} if room is None else {"room": room}
+                            if isinstance(cursor, int) and cursor > 0:
+                                page = history.page(max(0, len(history) - cursor), **content)
+                            else:
+                                page = history.snapshot(**content)
+                            client.send(page.frameFor(client))
                 elif packet.type == "message":
                     wslogger.debug(f"Client {client.client_uuid} sent a message.")
+                    room = packet.content.get("room")
 
                     if packet["author"] == config.server_nickname:
                         wslogger.debug(f"Client's ({client.client_uuid}) message rejected for using server nickname - {packet['author']}.")
-                        await ws.send_text(
+                        client.send(
                             Message(
                                 client.server_uuid,
                                 f"Имя '{config.server_nickname}' является серверным. Его нельзя использовать.",
                                 config.server_nickname,
                                 int(time.time())
-                            ).wsPacket
+                            )
                         )
 
+                    elif room is not None and room not in client.rooms:
+                        not_in_room(client, room)
+
                     else:
                         if any([x in packet["text"] for x in ("<audio", "<img", "<video")]):
-                            if isLxmlInstalled():
-                                text = await asyncio.to_thread(process_message, packet, ws.headers.get("host"))
-                            else:
-                                text = packet["text"]
-                                wslogger.warning("Requirements for tag formatting (img/video/audio) not installed. For sending files in chat install bs4 and lxml libs: pip install beautifulsoup4 lxml")
+                            text = await process_message(packet, ws.headers.get("host"))
                         else:
                             text = packet["text"]
 
                         if len(text) > config.server_message_size:
                             wslogger.debug(f"Client's ({client.client_uuid}) message too big - {len(text)}, max allowed is {config.server_message_size}.")
-                            await ws.send_text(
+                            client.send(
                                 Message(
                                     client.server_uuid,
                                     f"Сообщение слишком большое (>{config.server_message_size}).",
                                     config.server_nickname,
                                     int(time.time())
-                                ).wsPacket
+                                )
                             )
                         else:
-                            wslogger.debug(f"chat / {client.client_uuid}::{client.nickname}: {text}")
+                            wslogger.debug(f"chat / {'' if room is None else room + ' / '}{client.client_uuid}::{client.nickname}: {text}")
                         
-                            messages.append({"text": text, "author": packet["author"], "id": packet["id"]})
-                            if len(messages) > config.server_history_size:
-                                messages.popleft()
-                            
-                            await broadcast(
+                            await backplane.publish(
                                 text,
                                 client.nickname,
-                                packet["id"]
+                                packet["id"],
+                                room
                             )
+
+                elif packet.type == "joinRoom":
+                    room = packet.content.get("room")
+                    wslogger.debug(f"Client {client.client_uuid} requested to join room '{room}'.")
+
+                    if not isinstance(room, str) or not 0 < len(room) <= config.room_name_size:
+                        notify(client, f"Некорректное название комнаты (до {config.room_name_size} символов).")
+                    elif room in client.rooms:
+                        client.send(JoinRoom(client.server_uuid, room))
+                    elif len(client.rooms) >= config.client_max_rooms:
+                        notify(client, f"Нельзя находиться больше чем в {config.client_max_rooms} комнатах.")
+                    else:
+                        joined = await enter_room(client, room)
+                        if joined is not None:
+                            client.send(JoinRoom(client.server_uuid, room))
+                            client.send(joined.history.snapshot(room=room).frameFor(client))
+
+                elif packet.type == "leaveRoom":
+                    room = packet.content.get("room")
+                    wslogger.debug(f"Client {client.client_uuid} left room '{room}'.")
+                    if room in client.rooms:
+                        leave_room(client, room)
+                    client.send(LeaveRoom(client.server_uuid, room))
                 
                 elif packet.type == "privateMessage":
                     wslogger.debug(f"Client {client.client_uuid} requested private message ('{packet['author']}'->'{packet['touser']}').")
 
                     if config.server_nickname == packet['author']:
                         wslogger.debug(f"Client's ({client.client_uuid}) private message rejected for using server nickname.")
-                        await ws.send_text(
+                        client.send(
                             Message(
                                 client.server_uuid,
                                 f"Имя '{config.server_nickname}' является серверным. Его нельзя использовать.",
                                 config.server_nickname,
                                 int(time.time())
-                            ).wsPacket
+                            )
                         )
                     
                     else:
-                        touser = None
-                        for x in clients:
-                            if x.nickname == packet["touser"]:
-                                touser = x
-                                break
-                        
-                        if touser is None:
+                        touser = clients.get_nickname(packet["touser"])
+
+                        if touser is None and await backplane.private(packet["touser"], client.nickname, packet["text"]):
+                            wslogger.debug(f"privateChat / {client.client_uuid}::{client.nickname}->{packet['touser']} (other shard): {packet['text']}")
+                            client.send(
+                                Message(
+                                    client.server_uuid,
+                                    packet["text"],
+                                    f"{packet['touser']}<=",
+                                    int(time.time())
+                                )
+                            )
+                        elif touser is None:
                             wslogger.debug(f"Client's ({client.client_uuid}) private message can't delivered, touser is unknown client.")
-                            await ws.send_text(
+                            client.send(
                                 Message(
                                     client.server_uuid,
                                     f"Пользователь '{packet['touser']}' не найден.",
                                     config.server_nickname,
                                     int(time.time())
-                                ).wsPacket
+                                )
                             )
                         else:
                             wslogger.debug(f"privateChat / {client.client_uuid}::{client.nickname}->{touser.nickname}: {packet['text']}")
-                            await ws.send_text(
+                            client.send(
                                 Message(
                                     client.server_uuid,
                                     packet["text"],
                                     f"{touser.nickname}<=",
                                     int(time.time())
-                                ).wsPacket
+                                )
                             )
-                            await touser.ws.send_text(
+                            touser.send(
                                 Message(
-                                    client.server_uuid,
+                                    touser.server_uuid,
                                     packet["text"],
                                     f"{client.nickname}=>",
                                     int(time.time())
-                                ).wsPacket
+                                )
                             )
                 
                 elif packet.type == "disconnect":
                     wslogger.debug(f"Client {client.client_uuid} disconnected.")
-                    clients.discard(client)
-                    await ws.send_text(
+                    clients.remove(client)
+                    client.send(
                         DisconnectionAgree(
                             client.server_uuid
-                        ).wsPacket
+                        )
                     )
-                    await ws.close()
+                    client.close()
                     break
 
                 elif packet.type == "nickchange":
                     wslogger.debug(f"Client {client.client_uuid} requested nickname change ({client.nickname}->{packet['nickname']}).")
 
-                    for x in clients:
-                        if x.nickname == packet['nickname']:
-                            await ws.send_text(
-                                Message(
-                                    client.server_uuid,
-                                    "Ник уже используется другим пользователем.",
-                                    config.server_nickname,
-                                    int(time.time())
-                                ).wsPacket
+                    previous = client.nickname
+                    if clients.get_nickname(packet['nickname']) is not None or not await backplane.claim(packet['nickname'], client.client_uuid) or not clients.rename(client, packet['nickname']):
+                        client.send(
+                            Message(
+                                client.server_uuid,
+                                "Ник уже используется другим пользователем.",
+                                config.server_nickname,
+                                int(time.time())
                             )
-                            break
+                        )
                     else:
-                        client.nickname = packet['nickname']
-                        await ws.send_text(
+                        backplane.release(previous)
+                        client.send(
                             NicknameChange(
                                 client.server_uuid,
                                 packet['nickname']
-                            ).wsPacket
+                            )
                         )
     
     except WebSocketDisconnect:
         wslogger.debug("Websocket disconnected, discarding client.")
-        for client in clients.copy():
-            if ws == client.ws:
-                clients.discard(client)
-                break
 
     except Exception as e:
         wslogger.debug(f"Got exception: {e}")
         async with asyncopen(os.path.join(config.errorlog_directory, f"exception-{int(time.time())}.log"), "w") as f:
             await f.write(f"Error log on {datetime.now().strftime('%d-%m-%y at %H:%M:%S')}.\n\n{traceback.format_exc()}")
 
+    finally:
+        if handshaking:
+            handshakes -= 1
+        if client is not None:
+            if client.limiter is not None:
+                detach_limiter(host)
+            parked_rooms = tuple(client.rooms)
+            for room in parked_rooms:
+                leave_room(client, room)
+            # Lost connection of a resumable client, nickname and token are kept for resume_grace seconds.
+            if client.token is not None and not client.closing and clients.park(client):
+                wslogger.debug(f"Client {client.client_uuid} ({client.nickname}) parked for {config.resume_grace}s.")
+                client.parked_rooms = parked_rooms
+                client.parked_until = time.monotonic() + config.resume_grace
+            else:
+                clients.remove(client)
+                release_nickname(client)
+            if client.writer is not None:
+                # Let the writer flush frames queued before close(), the socket is gone once handler returns.
+                if client.closing:
+                    await asyncio.wait([client.writer], timeout=5)
+                client.writer.cancel()
+
 if __name__ == "__main__":
     from uvicorn import Server, Config
+    from uvicorn.supervisors import Multiprocess
 
+    # Workers import the app by name, single worker runs this module's app.
     if config.certs is None:
         cfg = Config(
-            app,
+            app if config.workers <= 1 else "server:app",
                 config.ip,
                 config.port,
-                workers=1,
+                workers=config.workers,
+                ws=DeflateWebSocketProtocol,
+                ws_per_message_deflate=config.ws_deflate,
+                ws_ping_interval=config.heartbeat_interval if config.heartbeat_interval > 0 else None,
+                ws_ping_timeout=config.heartbeat_timeout if config.heartbeat_timeout > 0 else None,
                 access_log=False
             )
     else:
         cfg = Config(
-            app,
+            app if config.workers <= 1 else "server:app",
                 config.ip,
                 config.port,
-                workers=1,
+                workers=config.workers,
+                ws=DeflateWebSocketProtocol,
+                ws_per_message_deflate=config.ws_deflate,
+                ws_ping_interval=config.heartbeat_interval if config.heartbeat_interval > 0 else None,
+                ws_ping_timeout=config.heartbeat_timeout if config.heartbeat_timeout > 0 else None,
                 ssl_certfile=config.certs[0],
                 ssl_keyfile=config.certs[1],
                 access_log=False
@@ -584,7 +1380,22 @@ if __name__ == "__main__":
     
     server = Server(cfg)
 
-    try:
-        server.run()
-    except KeyboardInterrupt:
-        server.should_exit = True
\ No newline at end of file
+    if config.workers > 1:
+        broker = Broker(
+            config.backplane_socket,
+            messages,
+            msglog,
+            backplanelogger,
+            config.rooms_max,
+            config.room_history_size
+        )
+        broker.start()
+        try:
+            Multiprocess(cfg, target=server.run, sockets=[cfg.bind_socket()]).run()
+        finally:
+            broker.stop()
+    else:
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            server.should_exit = True
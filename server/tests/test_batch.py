@@ -0,0 +1,113 @@
+import asyncio
+import glob
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import pytest
+import websockets
+
+SERVER = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Server modules copied into a temp directory, server.py reads muco-server.json next to itself.
+# Batches are flushed only every 2 seconds, so a client can connect while one is pending.
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    path = tmp_path_factory.mktemp("server")
+    for name in glob.glob(os.path.join(SERVER, "*.py")):
+        shutil.copy(name, path)
+    port = free_port()
+    with open(path / "muco-server.json", "w") as f:
+        json.dump({
+            "ip": "127.0.0.1",
+            "port": port,
+            "plugins_directory": str(path / "plugins"),
+            "batch_interval": 2.0,
+            "batch_size": 1000,
+            "rate_limits": {"*": [1000.0, 1000]},
+            "rate_limits_ip": {"*": [1000.0, 1000]}
+        }, f)
+
+    process = subprocess.Popen([sys.executable, "server.py"], cwd=path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                pytest.fail("server didn't start")
+            time.sleep(0.1)
+    yield f"ws://127.0.0.1:{port}/"
+    process.terminate()
+    process.wait(10)
+
+async def connect(url: str, nickname: str):
+    ws = await websockets.connect(url)
+    meta = json.loads(await ws.recv())
+    await ws.send(json.dumps({"type": "connmeta", "uuid": nickname, "nickname": nickname, "version": meta["version"], "batch": True}))
+    accept = json.loads(await ws.recv())
+    assert accept["type"] == "connaccept" and accept.get("batch") is True
+    return ws
+
+async def send(ws, nickname: str, count: int, room: str | None = None):
+    for i in range(count):
+        await ws.send(json.dumps({"type": "message", "uuid": nickname, "text": f"{nickname} {i}", "author": nickname, "id": i} | ({} if room is None else {"room": room})))
+
+# seq of every chat message the client got in history and "messages" packets until nothing arrives for a while.
+async def received(ws, timeout: float = 3.0) -> list[int]:
+    seqs = []
+    try:
+        while True:
+            packet = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+            if packet["type"] in ("history", "messages"):
+                seqs += [x["seq"] for x in packet["messages"]]
+    except asyncio.TimeoutError:
+        return seqs
+
+def test_connect_during_pending_batch(server):
+    async def run():
+        sender = await connect(server, "sender")
+        await send(sender, "sender", 8)
+        await asyncio.sleep(0.2)
+
+        late = await connect(server, "late")
+        await late.send(json.dumps({"type": "getHistory", "uuid": "late"}))
+        await send(sender, "sender", 4)
+        seqs = await received(late)
+        await sender.close()
+        await late.close()
+        return seqs
+
+    seqs = asyncio.run(run())
+    assert len(seqs) == 12
+    assert len(seqs) == len(set(seqs))
+
+def test_join_room_during_pending_batch(server):
+    async def run():
+        sender = await connect(server, "roomsender")
+        await sender.send(json.dumps({"type": "joinRoom", "uuid": "roomsender", "room": "r"}))
+        await send(sender, "roomsender", 8, "r")
+        await asyncio.sleep(0.2)
+
+        late = await connect(server, "roomlate")
+        await received(late, 0.5)
+        await late.send(json.dumps({"type": "joinRoom", "uuid": "roomlate", "room": "r"}))
+        await send(sender, "roomsender", 4, "r")
+        seqs = await received(late)
+        await sender.close()
+        await late.close()
+        return seqs
+
+    seqs = asyncio.run(run())
+    assert len(seqs) == 12
+    assert len(seqs) == len(set(seqs))
@@ -0,0 +1,40 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from core import ClientData
+
+def client(policy: str) -> ClientData:
+    return ClientData(None, "client", "server", queue_size=4, queue_policy=policy)
+
+def test_coalesce_keeps_frames_not_in_history():
+    x = client("coalesce")
+    x.send("private 0")
+    for i in range(3):
+        x.send(f"history {i}", covered=True)
+    assert x.send("history 3", covered=True)
+    assert x.resync
+    assert [frame for frame, _ in x.outbox] == ["private 0"]
+
+    # Frames the resync doesn't cover are still queued while it's pending.
+    assert x.send("private 1")
+    assert x.send("history 4", covered=True)
+    assert [frame for frame, _ in x.outbox] == ["private 0", "private 1"]
+    assert x.dropped == 5
+
+def test_coalesce_disconnects_without_history_to_drop():
+    x = client("coalesce")
+    for i in range(4):
+        x.send(f"private {i}")
+    assert not x.send("private 4")
+    assert x.closing
+    assert list(x.outbox) == [(None, False)]
+
+def test_disconnect_closes_on_direct_send():
+    x = client("disconnect")
+    for i in range(4):
+        x.send(f"notice {i}")
+    assert not x.send("notice 4")
+    assert x.closing and x.close_reason == "send queue overflow"
+    assert list(x.outbox) == [(None, False)]
+    assert not x.send("notice 5")